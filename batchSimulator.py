@@ -0,0 +1,252 @@
+# batchSimulator.py
+# -----------------
+# A vectorized forward model for running many games side by side.
+
+"""
+BatchSimulator holds numGames copies of a game as NumPy arrays (positions,
+directions, scared timers, food and capsule masks, score and win/lose flags)
+and advances all of them one ply per call to step, following the same rules
+as PacmanRules and GhostRules in pacman.py: illegal pacman actions become
+Stop, ghosts pick uniformly among their legal moves, scared ghosts move at
+half speed, and so on.
+
+Positions are stored doubled, so the half steps of scared ghosts stay
+integers.  Ghost moves are drawn from the simulator's own NumPy generator,
+not from the random module, so batches don't disturb the game's random
+stream.  Steps are not charged against Game.currentIterations; agents pay
+for them themselves, one iteration per ply of every game, as many as
+generatePacmanSuccessor would charge for the same plies.  affordableGames
+says how many games the rest of the budget pays for.
+"""
+
+from game import Directions
+from game import Actions
+from game import Game
+import pacman
+
+try:
+    import numpy
+    _NUMPY_ENABLED = True
+except ImportError:
+    _NUMPY_ENABLED = False
+
+DIRECTIONS = [Directions.NORTH, Directions.SOUTH, Directions.EAST, Directions.WEST, Directions.STOP]
+DIRECTION_INDEX = dict([(d, i) for i, d in enumerate(DIRECTIONS)])
+STOP = DIRECTION_INDEX[Directions.STOP]
+
+def affordableGames(numGames, plies):
+    """
+    How many of numGames games of plies plies each the rest of the forward
+    model budget pays for.  Like successors, they have to leave the budget
+    above 0.
+    """
+    return max(0, min(numGames, int(Game.currentIterations - 1) / plies))
+
+class BatchSimulator:
+    """
+    numGames copies of the game in state, advanced together.
+    """
+    def __init__(self, state, numGames, seed=None):
+        if not _NUMPY_ENABLED: raise Exception('BatchSimulator requires NumPy')
+        self.numGames = numGames
+        self.numGhosts = state.getNumAgents() - 1
+        self.random = numpy.random.RandomState(seed)
+        self.layout = state.data.layout
+        self.initializeTables(self.layout)
+        self.initializeRoot(state)
+        self.reset()
+
+    def initializeTables(self, layout):
+        """
+        Turns the layout's per-cell move tables into arrays indexed by cell.
+        """
+        height = self.height = layout.height
+        numCells = layout.width * height
+        self.dx = numpy.array([Actions.directionToVector(d)[0] for d in DIRECTIONS], dtype=int)
+        self.dy = numpy.array([Actions.directionToVector(d)[1] for d in DIRECTIONS], dtype=int)
+
+        # Pacman: which actions are legal, and the legal moves other than Stop
+        self.pacmanLegal = numpy.zeros((numCells, len(DIRECTIONS)), dtype=bool)
+        self.pacmanMoves = numpy.full((numCells, 4), STOP, dtype=int)
+        self.pacmanNumMoves = numpy.zeros(numCells, dtype=int)
+        # Ghosts: the legal moves given the direction the ghost came from
+        self.ghostMoves = numpy.full((numCells, len(DIRECTIONS), 4), STOP, dtype=int)
+        self.ghostNumMoves = numpy.zeros((numCells, len(DIRECTIONS)), dtype=int)
+        for cell in range(numCells):
+            if layout.legalActions[cell] is None: continue
+            for action in layout.legalActions[cell]:
+                self.pacmanLegal[cell, DIRECTION_INDEX[action]] = True
+            moves = layout.legalMoves[cell]
+            self.pacmanNumMoves[cell] = len(moves)
+            self.pacmanMoves[cell, :len(moves)] = [DIRECTION_INDEX[a] for a in moves]
+            for direction in DIRECTIONS:
+                # Same filtering as GhostRules.getLegalActions
+                possible = list(moves)
+                reverse = Actions.reverseDirection(direction)
+                if reverse in possible and len(possible) > 1:
+                    possible.remove(reverse)
+                d = DIRECTION_INDEX[direction]
+                self.ghostNumMoves[cell, d] = len(possible)
+                self.ghostMoves[cell, d, :len(possible)] = [DIRECTION_INDEX[a] for a in possible]
+
+    def initializeRoot(self, state):
+        """
+        Reads the game state that reset() goes back to.
+        """
+        data = state.data
+        agentStates = data.agentStates
+        def doubled(pos): return int(round(pos[0] * 2)), int(round(pos[1] * 2))
+        self.rootPacman = doubled(agentStates[0].getPosition()) + (DIRECTION_INDEX[agentStates[0].getDirection()],)
+        self.rootGhosts = [doubled(s.getPosition()) + (DIRECTION_INDEX[s.getDirection()], s.scaredTimer) for s in agentStates[1:]]
+        self.ghostStarts = numpy.array([doubled(s.start.getPosition()) for s in agentStates[1:]], dtype=int).reshape(-1, 2)
+        self.capsulePositions = numpy.array([doubled(c) for c in data.capsules], dtype=int).reshape(-1, 2)
+        self.rootFood = numpy.zeros(self.layout.width * self.height, dtype=bool)
+        for x, y in data.food.asList():
+            self.rootFood[x * self.height + y] = True
+        self.rootScore = data.score
+        self.rootWin = data._win
+        self.rootLose = data._lose
+
+    def reset(self):
+        """
+        Puts every game back to the state the simulator was made from.
+        """
+        n = self.numGames
+        self.pacmanX = numpy.full(n, self.rootPacman[0], dtype=int)
+        self.pacmanY = numpy.full(n, self.rootPacman[1], dtype=int)
+        self.pacmanDirection = numpy.full(n, self.rootPacman[2], dtype=int)
+        self.ghostX = numpy.tile(numpy.array([s[0] for s in self.rootGhosts], dtype=int), (n, 1))
+        self.ghostY = numpy.tile(numpy.array([s[1] for s in self.rootGhosts], dtype=int), (n, 1))
+        self.ghostDirection = numpy.tile(numpy.array([s[2] for s in self.rootGhosts], dtype=int), (n, 1))
+        self.scaredTimer = numpy.tile(numpy.array([s[3] for s in self.rootGhosts], dtype=int), (n, 1))
+        self.food = numpy.tile(self.rootFood, (n, 1))
+        self.numFood = self.food.sum(axis=1)
+        self.capsules = numpy.ones((n, len(self.capsulePositions)), dtype=bool)
+        self.score = numpy.full(n, self.rootScore, dtype=int)
+        self.win = numpy.full(n, self.rootWin, dtype=bool)
+        self.lose = numpy.full(n, self.rootLose, dtype=bool)
+
+    def step(self, actions):
+        """
+        Advances every game that isn't over by one ply: pacman takes the
+        corresponding action (a direction or its index in DIRECTIONS) and
+        then each ghost makes a random legal move.
+        """
+        if not isinstance(actions, numpy.ndarray):
+            actions = numpy.array([DIRECTION_INDEX.get(a, a) for a in actions], dtype=int)
+        games = numpy.arange(self.numGames)
+        active = ~(self.win | self.lose)
+        scoreChange = numpy.zeros(self.numGames, dtype=int)
+
+        # Pacman moves; anything illegal becomes Stop
+        cell = (self.pacmanX // 2) * self.height + self.pacmanY // 2
+        actions = numpy.where(self.pacmanLegal[cell, actions], actions, STOP)
+        self.pacmanX = numpy.where(active, self.pacmanX + 2 * self.dx[actions], self.pacmanX)
+        self.pacmanY = numpy.where(active, self.pacmanY + 2 * self.dy[actions], self.pacmanY)
+        self.pacmanDirection = numpy.where(active & (actions != STOP), actions, self.pacmanDirection)
+
+        # Eat food
+        cell = (self.pacmanX // 2) * self.height + self.pacmanY // 2
+        eaten = active & self.food[games, cell]
+        self.food[games[eaten], cell[eaten]] = False
+        self.numFood -= eaten
+        scoreChange += 10 * eaten
+        won = eaten & (self.numFood == 0) & ~self.lose
+        scoreChange += 500 * won
+        self.win |= won
+
+        # Eat capsules
+        for c, (x, y) in enumerate(self.capsulePositions):
+            eaten = active & self.capsules[:, c] & (self.pacmanX == x) & (self.pacmanY == y)
+            self.capsules[eaten, c] = False
+            self.scaredTimer[eaten] = pacman.SCARED_TIME
+
+        scoreChange -= pacman.TIME_PENALTY * active
+        for ghost in range(self.numGhosts):
+            self.checkDeath(ghost, active, scoreChange)
+
+        # Ghosts move in turn until the game ends
+        for ghost in range(self.numGhosts):
+            moving = ~(self.win | self.lose)
+            x, y = self.ghostX[:, ghost], self.ghostY[:, ghost]
+            direction, timer = self.ghostDirection[:, ghost], self.scaredTimer[:, ghost]
+
+            # In between grid points, ghosts must continue straight
+            onGrid = (x % 2 == 0) & (y % 2 == 0)
+            cell = (x // 2) * self.height + y // 2
+            numMoves = self.ghostNumMoves[cell, direction]
+            choice = numpy.minimum((self.random.random_sample(self.numGames) * numMoves).astype(int), 3)
+            action = numpy.where(onGrid, self.ghostMoves[cell, direction, choice], direction)
+
+            speed = numpy.where(timer > 0, 1, 2)
+            newX = x + self.dx[action] * speed
+            newY = y + self.dy[action] * speed
+            # A scared ghost snaps to the grid as its timer runs out
+            snap = timer == 1
+            newX = numpy.where(snap, (newX + 1) // 2 * 2, newX)
+            newY = numpy.where(snap, (newY + 1) // 2 * 2, newY)
+            self.ghostX[:, ghost] = numpy.where(moving, newX, x)
+            self.ghostY[:, ghost] = numpy.where(moving, newY, y)
+            self.ghostDirection[:, ghost] = numpy.where(moving & (action != STOP), action, direction)
+            self.scaredTimer[:, ghost] = numpy.where(moving, numpy.maximum(0, timer - 1), timer)
+            self.checkDeath(ghost, moving, scoreChange)
+
+        self.score += scoreChange
+
+    def checkDeath(self, ghost, mask, scoreChange):
+        """
+        Resolves collisions between pacman and the ghost in the masked games,
+        as GhostRules.collide does.
+        """
+        distance = abs(self.ghostX[:, ghost] - self.pacmanX) + abs(self.ghostY[:, ghost] - self.pacmanY)
+        # COLLISION_TOLERANCE in doubled coordinates, rounded down to a whole half step
+        collided = mask & (distance <= int(2 * pacman.COLLISION_TOLERANCE))
+        scared = collided & (self.scaredTimer[:, ghost] > 0)
+        scoreChange += 200 * scared
+        self.ghostX[scared, ghost] = self.ghostStarts[ghost, 0]
+        self.ghostY[scared, ghost] = self.ghostStarts[ghost, 1]
+        self.ghostDirection[scared, ghost] = STOP
+        self.scaredTimer[scared, ghost] = 0
+        killed = collided & ~scared & ~self.win
+        scoreChange -= 500 * killed
+        self.lose |= killed
+
+    def randomActions(self):
+        """
+        A random legal pacman move other than Stop for every game, like
+        agents pick from getLegalPacmanActions.
+        """
+        cell = (self.pacmanX // 2) * self.height + self.pacmanY // 2
+        numMoves = self.pacmanNumMoves[cell]
+        choice = numpy.minimum((self.random.random_sample(self.numGames) * numMoves).astype(int), 3)
+        return self.pacmanMoves[cell, choice]
+
+    def evaluate(self):
+        """
+        scoreEvaluation (see heuristics.py) for every game.
+        """
+        return self.score + 1000.0 * self.win - 1000.0 * self.lose
+
+    def rollout(self, sequences):
+        """
+        Plays each game from the start state through its row of sequences
+        (directions or their indices, in a list of lists or an array) and
+        returns the evaluations of where they end up.
+        """
+        if not isinstance(sequences, numpy.ndarray):
+            sequences = numpy.array([[DIRECTION_INDEX.get(a, a) for a in sequence] for sequence in sequences], dtype=int)
+        self.reset()
+        for t in range(sequences.shape[1]):
+            self.step(sequences[:, t])
+        return self.evaluate()
+
+    def randomRollouts(self, firstActions, depth):
+        """
+        Plays firstActions[i] in game i, then random legal moves until depth
+        plies have been played, and returns the evaluations.
+        """
+        self.reset()
+        self.step(firstActions)
+        for t in range(depth - 1):
+            self.step(self.randomActions())
+        return self.evaluate()
@@ -0,0 +1,134 @@
+# distanceOracle.py
+# -----------------
+# True maze distances between all pairs of open cells of a layout.
+
+"""
+A DistanceOracle runs a breadth-first search from every open cell of a
+layout once and keeps the distances in a single array of unsigned 16-bit
+integers, row i holding the distances from the open cell numbered i.
+distance(a, b) is then two table lookups.
+
+Oracles are cached in memory and on disk (in .distanceCache next to this
+module), keyed by a hash of the layout text, so a layout is only searched
+the first time it is ever used.  If the cache can't be written the oracle
+still works; it is just computed again next time.
+
+  distances = state.data.layout.getDistances()
+  distances.distance(state.getPacmanPosition(), (1, 1))
+"""
+
+from array import array
+import hashlib, os
+
+CACHE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.distanceCache')
+UNREACHABLE = 65535
+
+_ORACLES = {}
+
+class DistanceOracle:
+    """
+    All-pairs maze distances of a layout.  Use forLayout to share oracles
+    between layouts with the same text.
+    """
+    def __init__(self, layout, key):
+        self.width = layout.width
+        self.height = layout.height
+        self.key = key
+        self.cellIds = array('i', [-1] * (layout.width * layout.height))
+        self.numCells = 0
+        for cell, neighbors in enumerate(layout.legalNeighbors):
+            if neighbors is None: continue
+            self.cellIds[cell] = self.numCells
+            self.numCells += 1
+        self.distances = self.load()
+        if self.distances is None:
+            self.distances = self.compute(layout)
+            self.save()
+
+    def forLayout(layout):
+        key = hashlib.sha1('\n'.join(layout.layoutText)).hexdigest()
+        if key not in _ORACLES:
+            _ORACLES[key] = DistanceOracle(layout, key)
+        return _ORACLES[key]
+    forLayout = staticmethod(forLayout)
+
+    def compute(self, layout):
+        """
+        Breadth-first searches from every open cell.
+        """
+        height, cellIds, numCells = self.height, self.cellIds, self.numCells
+        neighborIds = [None] * numCells
+        for cell, neighbors in enumerate(layout.legalNeighbors):
+            if neighbors is None: continue
+            neighborIds[cellIds[cell]] = [cellIds[x * height + y] for x, y in neighbors]
+        distances = array('H', [UNREACHABLE]) * (numCells * numCells)
+        for source in range(numCells):
+            row = source * numCells
+            distances[row + source] = 0
+            frontier = [source]
+            distance = 0
+            while frontier:
+                distance += 1
+                nextFrontier = []
+                for cell in frontier:
+                    for neighbor in neighborIds[cell]:
+                        if distances[row + neighbor] == UNREACHABLE:
+                            distances[row + neighbor] = distance
+                            nextFrontier.append(neighbor)
+                frontier = nextFrontier
+        return distances
+
+    def getCachePath(self):
+        return os.path.join(CACHE_DIRECTORY, self.key + '.dist')
+
+    def load(self):
+        """
+        The distances from the disk cache, or None.
+        """
+        try:
+            f = open(self.getCachePath(), 'rb')
+        except IOError:
+            return None
+        try:
+            distances = array('H')
+            try:
+                distances.fromfile(f, self.numCells * self.numCells)
+            except EOFError:
+                return None
+            # Anything left over means the file isn't ours
+            if f.read(1): return None
+            return distances
+        finally:
+            f.close()
+
+    def save(self):
+        path = self.getCachePath()
+        try:
+            if not os.path.isdir(CACHE_DIRECTORY):
+                os.makedirs(CACHE_DIRECTORY)
+            # Written under another name first, so readers never see half a file
+            partialPath = '%s.%d' % (path, os.getpid())
+            f = open(partialPath, 'wb')
+            try:
+                self.distances.tofile(f)
+            finally:
+                f.close()
+            os.rename(partialPath, path)
+        except (IOError, OSError):
+            pass
+
+    def distance(self, a, b):
+        """
+        The number of moves between positions a and b, or UNREACHABLE,
+        which is also the distance to or from a wall or off the map.
+        Positions between grid points (scared ghosts) count as the nearest
+        grid point.
+        """
+        width, height, cellIds = self.width, self.height, self.cellIds
+        ax, ay, bx, by = int(a[0] + 0.5), int(a[1] + 0.5), int(b[0] + 0.5), int(b[1] + 0.5)
+        if not (0 <= ax < width and 0 <= ay < height and 0 <= bx < width and 0 <= by < height):
+            return UNREACHABLE
+        i = cellIds[ax * height + ay]
+        j = cellIds[bx * height + by]
+        if i < 0 or j < 0: return UNREACHABLE
+        return self.distances[i * self.numCells + j]
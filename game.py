@@ -21,7 +21,7 @@
 # For more info, see http://inst.eecs.berkeley.edu/~cs188/sp09/pacman.html
 
 from util import *
-import time, os
+import time, os, random
 import traceback
 import sys
 
@@ -67,19 +67,44 @@ class Directions:
                WEST: EAST,
                STOP: STOP}
 
-class Configuration:
+class Configuration(object):
     """
     A Configuration holds the (x,y) coordinate of a character, along with its
     traveling direction.
 
     The convention for positions, like a graph, is that (0,0) is the lower left corner, x increases
     horizontally and y increases vertically.  Therefore, north is the direction of increasing y, or (0,1).
+
+    Configurations are never modified once made, so the game rules share one
+    interned Configuration per (position, direction) pair; see intern.
     """
+    __slots__ = ('pos', 'direction')
+    _interned = {}
 
     def __init__(self, pos, direction):
         self.pos = pos
         self.direction = direction
 
+    def intern(pos, direction):
+        """
+        Returns the shared Configuration for pos and direction, making it the
+        first time it is asked for.  Integer and float positions are kept
+        apart so callers get back the kind of coordinates they passed in.
+        """
+        key = (pos, direction, type(pos[0]))
+        conf = Configuration._interned.get(key)
+        if conf is None:
+            conf = Configuration(pos, direction)
+            Configuration._interned[key] = conf
+        return conf
+    intern = staticmethod(intern)
+
+    def __getstate__(self):
+        return (self.pos, self.direction)
+
+    def __setstate__(self, state):
+        self.pos, self.direction = state
+
     def getPosition(self):
         return (self.pos)
 
@@ -91,7 +116,7 @@ class Configuration:
         return x == int(x) and y == int(y)
 
     def __eq__(self, other):
-        if other == None: return False
+        if other is None: return False
         return (self.pos == other.pos and self.direction == other.direction)
 
     def __hash__(self):
@@ -115,12 +140,13 @@ class Configuration:
         direction = Actions.vectorToDirection(vector)
         if direction == Directions.STOP:
             direction = self.direction # There is no stop direction
-        return Configuration((x + dx, y+dy), direction)
+        return Configuration.intern((x + dx, y+dy), direction)
 
-class AgentState:
+class AgentState(object):
     """
     AgentStates hold the state of an agent (configuration, speed, scared, etc).
     """
+    __slots__ = ('start', 'configuration', 'isPacman', 'scaredTimer', 'numCarrying', 'numReturned')
 
     def __init__( self, startConfiguration, isPacman ):
         self.start = startConfiguration
@@ -137,13 +163,19 @@ class AgentState:
             return "Ghost: " + str( self.configuration )
 
     def __eq__( self, other ):
-        if other == None:
+        if other is None:
             return False
         return self.configuration == other.configuration and self.scaredTimer == other.scaredTimer
 
     def __hash__(self):
         return hash(hash(self.configuration) + 13 * hash(self.scaredTimer))
 
+    def __getstate__( self ):
+        return (self.start, self.configuration, self.isPacman, self.scaredTimer, self.numCarrying, self.numReturned)
+
+    def __setstate__( self, state ):
+        (self.start, self.configuration, self.isPacman, self.scaredTimer, self.numCarrying, self.numReturned) = state
+
     def copy( self ):
         state = AgentState( self.start, self.isPacman )
         state.configuration = self.configuration
@@ -159,6 +191,36 @@ class AgentState:
     def getDirection(self):
         return self.configuration.getDirection()
 
+class FrozenList(list):
+    """
+    A list of a frozen GameState (see GameState.freeze), which can't be
+    changed.  It still compares equal to plain lists with the same items,
+    and slices and list() copies of it are plain lists.
+    """
+    def _readOnly( self, *args ):
+        raise Exception('Can\'t modify a list of a frozen game state')
+
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = _readOnly
+    __iadd__ = __imul__ = append = extend = insert = pop = remove = reverse = sort = _readOnly
+
+    def __reduce__( self ):
+        # Pickling would otherwise rebuild the list with append
+        return (FrozenList, (list(self),))
+
+class FrozenAgentState(AgentState):
+    """
+    The agent state of a frozen GameState (see GameState.freeze), which
+    can't be written.  Copies are plain AgentStates again.
+    """
+    __slots__ = ()
+
+    def __setattr__( self, name, value ):
+        raise Exception('Can\'t modify the agent state of a frozen game state')
+
+    def __setstate__( self, state ):
+        for name, value in zip( AgentState.__slots__, state ):
+            object.__setattr__( self, name, value )
+
 class Grid:
     """
     A 2-dimensional array of objects backed by a list of lists.  Data is accessed
@@ -190,6 +252,7 @@ class Grid:
 
     def __eq__(self, other):
         if other == None: return False
+        if isinstance(other, BitGrid): return other == self
         return self.data == other.data
 
     def __hash__(self):
@@ -274,6 +337,125 @@ class Grid:
                 bools.append(False)
         return bools
 
+class BitGrid(Grid):
+    """
+    A boolean Grid packed into a single arbitrary-precision int.  Cell (x,y)
+    is bit x * height + y, the same order Grid.__hash__ uses, so the two
+    kinds of grid hash alike.
+
+    Data is still accessed via grid[x][y], for reading and writing.  Since
+    ints are immutable, copies share the int until one of them is written,
+    which makes copy() O(1); count() is a popcount and __hash__ hashes the
+    int directly.
+    """
+    def __init__(self, width, height, initialValue=False, bitRepresentation=None):
+        if initialValue not in [False, True]: raise Exception('Grids can only contain booleans')
+        self.CELLS_PER_INT = 30
+
+        self.width = width
+        self.height = height
+        self.bits = 0
+        self.frozen = False
+        if initialValue:
+            self.bits = (1 << (width * height)) - 1
+        if bitRepresentation:
+            self._unpackBits(bitRepresentation)
+
+    def __getitem__(self, i):
+        if i < 0: i += self.width
+        if i < 0 or i >= self.width: raise IndexError('grid index out of range')
+        return _BitGridColumn(self, i)
+
+    def __setitem__(self, key, item):
+        column = self[key]
+        for y in range(self.height):
+            column[y] = item[y]
+
+    def __len__(self):
+        return self.width
+
+    def __str__(self):
+        out = [[str(self[x][y])[0] for x in range(self.width)] for y in range(self.height)]
+        out.reverse()
+        return '\n'.join([''.join(x) for x in out])
+
+    def __eq__(self, other):
+        if not isinstance(other, Grid): return False
+        if self.width != other.width or self.height != other.height: return False
+        if isinstance(other, BitGrid): return self.bits == other.bits
+        return self.asList() == other.asList()
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.bits)
+
+    def copy(self):
+        g = BitGrid(self.width, self.height)
+        g.bits = self.bits
+        return g
+
+    def freeze(self):
+        """
+        Makes the grid read-only.  Copies of a frozen grid can still be written.
+        """
+        self.frozen = True
+
+    def deepCopy(self):
+        return self.copy()
+
+    def shallowCopy(self):
+        return self.copy()
+
+    def count(self, item =True ):
+        numTrue = bin(self.bits).count('1')
+        if item is True: return numTrue
+        if item is False: return self.width * self.height - numTrue
+        return 0
+
+    def asList(self, key = True):
+        if key is not True and key is not False: return []
+        bits = self.bits
+        if key is False:
+            bits = ~bits & ((1 << (self.width * self.height)) - 1)
+        list = []
+        index = 0
+        while bits:
+            if bits & 1:
+                list.append( self._cellIndexToPosition(index) )
+            bits >>= 1
+            index += 1
+        return list
+
+class _BitGridColumn:
+    """
+    The grid[x] view of a BitGrid; reads and writes go straight to the
+    grid's bits.
+    """
+    def __init__(self, grid, x):
+        self.grid = grid
+        self.offset = x * grid.height
+
+    def __getitem__(self, y):
+        height = self.grid.height
+        if y < 0: y += height
+        if y < 0 or y >= height: raise IndexError('grid index out of range')
+        return (self.grid.bits >> (self.offset + y)) & 1 == 1
+
+    def __setitem__(self, y, value):
+        if self.grid.frozen: raise Exception('Can\'t modify a frozen grid')
+        height = self.grid.height
+        if y < 0: y += height
+        if y < 0 or y >= height: raise IndexError('grid index out of range')
+        if value:
+            self.grid.bits |= 1 << (self.offset + y)
+        else:
+            self.grid.bits &= ~(1 << (self.offset + y))
+
+    def __len__(self):
+        return self.grid.height
+
 def reconstituteGrid(bitRep):
     if type(bitRep) is not type((1,2)):
         return bitRep
@@ -348,6 +530,42 @@ class Actions:
 
     getPossibleActions = staticmethod(getPossibleActions)
 
+    def getLegalActions(config, layout):
+        """
+        Same as getPossibleActions, but looked up in the layout's move table.
+        """
+        x, y = config.pos
+        x_int, y_int = int(x + 0.5), int(y + 0.5)
+
+        # In between grid points, all agents must continue straight
+        if (abs(x - x_int) + abs(y - y_int)  > Actions.TOLERANCE):
+            return [config.getDirection()]
+
+        actions = layout.legalActions[x_int * layout.height + y_int]
+        if actions is None: return Actions.getPossibleActions(config, layout.walls)
+        return list(actions)
+    getLegalActions = staticmethod(getLegalActions)
+
+    def getLegalMoves(config, layout):
+        """
+        The legal actions for config other than Stop.
+        """
+        x, y = config.pos
+        x_int, y_int = int(x + 0.5), int(y + 0.5)
+
+        if (abs(x - x_int) + abs(y - y_int)  > Actions.TOLERANCE):
+            direction = config.getDirection()
+            if direction == Directions.STOP: return []
+            return [direction]
+
+        moves = layout.legalMoves[x_int * layout.height + y_int]
+        if moves is None:
+            moves = Actions.getPossibleActions(config, layout.walls)
+            if Directions.STOP in moves: moves.remove(Directions.STOP)
+            return moves
+        return list(moves)
+    getLegalMoves = staticmethod(getLegalMoves)
+
     def getLegalNeighbors(position, walls):
         x,y = position
         x_int, y_int = int(x + 0.5), int(y + 0.5)
@@ -368,6 +586,42 @@ class Actions:
         return (x + dx, y + dy)
     getSuccessor = staticmethod(getSuccessor)
 
+class ZobristKeys:
+    """
+    The random 64-bit keys that GameStateData hashes are built from.  A key
+    is drawn the first time an item is seen, from a generator seeded with
+    the item's hash, so keys are the same in every process and never disturb
+    the game's own random stream.
+    """
+    _keys = {}
+
+    def get(*item):
+        key = ZobristKeys._keys.get(item)
+        if key is None:
+            key = random.Random(hash(item)).getrandbits(64)
+            ZobristKeys._keys[item] = key
+        return key
+    get = staticmethod(get)
+
+    def agent(index, configuration, scaredTimer):
+        h = ZobristKeys.get('scaredTimer', index, scaredTimer)
+        if configuration == None:
+            return h ^ ZobristKeys.get('configuration', index, None, None)
+        return h ^ ZobristKeys.get('configuration', index, configuration.pos, configuration.direction)
+    agent = staticmethod(agent)
+
+    def food(position):
+        return ZobristKeys.get('food', position)
+    food = staticmethod(food)
+
+    def capsule(position):
+        return ZobristKeys.get('capsule', position)
+    capsule = staticmethod(capsule)
+
+    def score(score):
+        return ZobristKeys.get('score', score)
+    score = staticmethod(score)
+
 class GameStateData:
     """
 
@@ -378,7 +632,8 @@ class GameStateData:
         """
         if prevState != None:
             self.food = prevState.food.shallowCopy()
-            self.capsules = prevState.capsules[:]
+            self.numFood = prevState.numFood
+            self.capsules = list(prevState.capsules)
             self.agentStates = self.copyAgentStates( prevState.agentStates )
             self.layout = prevState.layout
             self._eaten = prevState._eaten
@@ -391,15 +646,16 @@ class GameStateData:
         self._lose = False
         self._win = False
         self.scoreChange = 0
+        self._hash = None
 
     def deepCopy( self ):
         state = GameStateData( self )
         state.food = self.food.deepCopy()
-        state.layout = self.layout.deepCopy()
         state._agentMoved = self._agentMoved
         state._foodEaten = self._foodEaten
         state._foodAdded = self._foodAdded
         state._capsuleEaten = self._capsuleEaten
+        state._hash = self._hash
         return state
 
     def copyAgentStates( self, agentStates ):
@@ -423,14 +679,79 @@ class GameStateData:
     def __hash__( self ):
         """
         Allows states to be keys of dictionaries.
+
+        This is a 64-bit Zobrist hash: the XOR of a random key for every agent
+        configuration and scared timer, food pellet, capsule and the score.
+        GameState.generateSuccessor keeps it up to date with updateHash, so
+        it only has to be computed from scratch for the initial state.
         """
-        for i, state in enumerate( self.agentStates ):
-            try:
-                int(hash(state))
-            except TypeError, e:
-                print e
-                #hash(state)
-        return int((hash(tuple(self.agentStates)) + 13*hash(self.food) + 113* hash(tuple(self.capsules)) + 7 * hash(self.score)) % 1048575 )
+        if self._hash is None:
+            self._hash = self.computeHash()
+        return self._hash
+
+    def computeHash( self ):
+        """
+        Computes the Zobrist hash of this state from scratch.
+        """
+        h = ZobristKeys.score( self.score )
+        for index, agentState in enumerate( self.agentStates ):
+            h ^= ZobristKeys.agent( index, agentState.configuration, agentState.scaredTimer )
+        for position in self.food.asList():
+            h ^= ZobristKeys.food( position )
+        for position in self.capsules:
+            h ^= ZobristKeys.capsule( position )
+        return h
+
+    def getAgentSnapshot( self ):
+        """
+        The (configuration, scaredTimer) of every agent, all updateHash needs
+        to know about the agents of a previous state.
+        """
+        return [(agentState.configuration, agentState.scaredTimer) for agentState in self.agentStates]
+
+    def updateHash( self, prevState ):
+        """
+        Derives this state's hash from the hash of prevState, the state it was
+        generated from, by XOR-ing out what changed between the two.
+        """
+        return self.updateHashFrom( prevState._hash, prevState.score, prevState.getAgentSnapshot() )
+
+    def updateHashFrom( self, prevHash, prevScore, prevAgents ):
+        """
+        updateHash given the hash, score and agent snapshot of the previous
+        state instead of the state itself, for states changed in place.
+        """
+        h = prevHash
+        if h is None: return None
+        if self.score != prevScore:
+            h ^= ZobristKeys.score( prevScore ) ^ ZobristKeys.score( self.score )
+        for index, agentState in enumerate( self.agentStates ):
+            configuration, scaredTimer = prevAgents[index]
+            # Rules replace configurations rather than edit them, so identity is enough
+            if agentState.configuration is not configuration or agentState.scaredTimer != scaredTimer:
+                h ^= ZobristKeys.agent( index, configuration, scaredTimer )
+                h ^= ZobristKeys.agent( index, agentState.configuration, agentState.scaredTimer )
+        if self._foodEaten != None:
+            h ^= ZobristKeys.food( self._foodEaten )
+        if self._foodAdded != None:
+            h ^= ZobristKeys.food( self._foodAdded )
+        if self._capsuleEaten != None:
+            h ^= ZobristKeys.capsule( self._capsuleEaten )
+        return h
+
+    def freeze( self ):
+        """
+        Makes this data read-only; see GameState.freeze.
+        """
+        # __hash__ fills in _hash, which frozen data can't
+        hash( self )
+        self.food.freeze()
+        self.capsules = FrozenList( self.capsules )
+        self.agentStates = FrozenList( self.agentStates )
+        self._eaten = FrozenList( self._eaten )
+        for agentState in self.agentStates:
+            agentState.__class__ = FrozenAgentState
+        self.__class__ = FrozenGameStateData
 
     def __str__( self ):
         width, height = self.layout.width, self.layout.height
@@ -489,8 +810,9 @@ class GameStateData:
         Creates an initial game state from a layout array (see layout.py).
         """
         self.food = layout.food.copy()
+        self.numFood = self.food.count()
         #self.capsules = []
-        self.capsules = layout.capsules[:]
+        self.capsules = list(layout.capsules)
         self.layout = layout
         self.score = 0
         self.scoreChange = 0
@@ -501,8 +823,9 @@ class GameStateData:
             if not isPacman:
                 if numGhosts == numGhostAgents: continue # Max ghosts reached already
                 else: numGhosts += 1
-            self.agentStates.append( AgentState( Configuration( pos, Directions.STOP), isPacman) )
+            self.agentStates.append( AgentState( Configuration.intern( pos, Directions.STOP), isPacman) )
         self._eaten = [False for a in self.agentStates]
+        self._hash = self.computeHash()
 
 try:
     import boinc
@@ -510,6 +833,14 @@ try:
 except:
     _BOINC_ENABLED = False
 
+class FrozenGameStateData(GameStateData):
+    """
+    The data of a frozen GameState, which can't be written.  Copies are
+    plain GameStateData again.
+    """
+    def __setattr__( self, name, value ):
+        raise Exception('Can\'t modify a frozen game state')
+
 class Game:
     """
     The Game manages the control flow, soliciting actions from agents.
@@ -521,6 +852,7 @@ class Game:
     movementHistory=[]
     notLossButTime = False
     fileName=""
+    copyObservations = False
 
     def __init__( self, agents, display, rules, startingIndex=0, muteAgents=False, catchExceptions=False ):
         self.agentCrashed = False
@@ -571,6 +903,20 @@ class Game:
         sys.stderr = OLD_STDERR
 
 
+    def observe( self ):
+        """
+        The observation of the current state handed to agents.  The game
+        never changes a state once it is made (every move makes a successor),
+        so by default agents are shown the state itself, frozen (see
+        GameState.freeze) so that they can't change it either; searching
+        agents copy it, with GameState or SearchState, before changing
+        anything.  Game.copyObservations (--copyObservations) hands out a
+        deep copy instead.
+        """
+        if Game.copyObservations: return self.state.deepCopy()
+        self.state.freeze()
+        return self.state
+
     def run( self ):
         """
         Main control loop for game play.
@@ -598,7 +944,7 @@ class Game:
                         timed_func = TimeoutFunction(agent.registerInitialState, int(self.rules.getMaxStartupTime(i)))
                         try:
                             start_time = time.time()
-                            timed_func(self.state.deepCopy())
+                            timed_func(self.observe())
                             time_taken = time.time() - start_time
                             self.totalAgentTimes[i] += time_taken
                         except TimeoutFunctionException:
@@ -612,7 +958,7 @@ class Game:
                         self.unmute()
                         return
                 else:
-                    agent.registerInitialState(self.state.deepCopy())
+                    agent.registerInitialState(self.observe())
                 ## TODO: could this exceed the total time
                 self.unmute()
 
@@ -626,7 +972,7 @@ class Game:
             move_time = 0
             skip_action = False
             # Generate an observation of the state
-            observation = self.state.deepCopy()
+            observation = self.observe()
 
             # Solicit an action
             action = None
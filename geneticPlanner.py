@@ -0,0 +1,99 @@
+# geneticPlanner.py
+# -----------------
+# A genetic algorithm over whole populations of action sequences at once.
+
+"""
+GeneticPlanner evolves a population of fixed-length pacman action sequences
+held in a single NumPy array.  Each action takes two bits (its index in
+batchSimulator.DIRECTIONS: north, south, east, west; pacman's possible
+actions other than Stop), packed four to a byte, so a chromosome of length
+L is a row of (L + 3) / 4 bytes.  Selection, crossover and mutation are
+array operations over the whole population:
+
+  - rank selection: parents are drawn with probability proportional to
+    their rank by fitness
+  - elitism: the best few chromosomes are carried over unchanged
+  - uniform crossover: with probability crossoverRate a pair of parents
+    swaps a random half of its genes, using a bit mask over the packed
+    bytes; otherwise the parents are copied
+  - mutation: every gene changes to another action with probability
+    mutationRate, by xor with a random nonzero 2-bit value
+"""
+
+try:
+    import numpy
+    _NUMPY_ENABLED = True
+except ImportError:
+    _NUMPY_ENABLED = False
+
+GENES_PER_BYTE = 4
+
+def packActions(genes):
+    """
+    Packs an array of action indices, one chromosome per row, into bytes.
+    """
+    numChromosomes, length = genes.shape
+    numBytes = (length + GENES_PER_BYTE - 1) / GENES_PER_BYTE
+    padded = numpy.zeros((numChromosomes, numBytes * GENES_PER_BYTE), dtype=numpy.uint8)
+    padded[:, :length] = genes
+    padded = padded.reshape(numChromosomes, numBytes, GENES_PER_BYTE)
+    return padded[:, :, 0] | padded[:, :, 1] << 2 | padded[:, :, 2] << 4 | padded[:, :, 3] << 6
+
+def unpackActions(packed, length):
+    """
+    The action indices of packed chromosomes of the given length.
+    """
+    shifts = numpy.arange(0, 2 * GENES_PER_BYTE, 2, dtype=numpy.uint8)
+    genes = (packed[:, :, numpy.newaxis] >> shifts) & 3
+    return genes.reshape(packed.shape[0], -1)[:, :length]
+
+class GeneticPlanner:
+    """
+    A population of populationSize random chromosomes of the given length.
+    """
+    def __init__(self, populationSize, length, elitism=2, crossoverRate=0.7, mutationRate=0.05, seed=None):
+        if not _NUMPY_ENABLED: raise Exception('GeneticPlanner requires NumPy')
+        if elitism >= populationSize: raise Exception('elitism must be smaller than the population')
+        self.populationSize = populationSize
+        self.length = length
+        self.elitism = elitism
+        self.crossoverRate = crossoverRate
+        self.mutationRate = mutationRate
+        self.random = numpy.random.RandomState(seed)
+        self.population = packActions(self.random.randint(0, 4, (populationSize, length)))
+
+    def getActions(self):
+        """
+        The population as an array of action indices, one row per
+        chromosome.
+        """
+        return unpackActions(self.population, self.length)
+
+    def nextGeneration(self, fitness):
+        """
+        Replaces the population with the next generation, given the fitness
+        of every chromosome.
+        """
+        order = numpy.argsort(fitness)
+        ranks = numpy.empty(self.populationSize)
+        ranks[order] = numpy.arange(1, self.populationSize + 1)
+        probabilities = ranks / ranks.sum()
+
+        numChildren = self.populationSize - self.elitism
+        numPairs = (numChildren + 1) / 2
+        parentsA = self.population[self.random.choice(self.populationSize, numPairs, p=probabilities)]
+        parentsB = self.population[self.random.choice(self.populationSize, numPairs, p=probabilities)]
+
+        # Uniform crossover: mask has both bits of every gene taken from A
+        fromA = self.random.random_sample((numPairs, self.length)) < 0.5
+        mask = packActions(fromA * numpy.uint8(3))
+        mask[self.random.random_sample(numPairs) >= self.crossoverRate] = 0xFF
+        children = numpy.concatenate([(parentsA & mask) | (parentsB & ~mask),
+                                      (parentsB & mask) | (parentsA & ~mask)])[:numChildren]
+
+        # Mutation
+        mutated = self.random.random_sample((numChildren, self.length)) < self.mutationRate
+        children ^= packActions(mutated * self.random.randint(1, 4, (numChildren, self.length)).astype(numpy.uint8))
+
+        elite = self.population[order[self.populationSize - self.elitism:]]
+        self.population = numpy.concatenate([elite, children])
@@ -11,8 +11,23 @@ def normalizedScoreEvaluation(rootState, currentState):
 def pelletsHeuristic(state):
     if state.isLose():
         return 1000.0;
-    return state.getNumFood() + len(self.state.getCapsules());
+    return state.getNumFood() + len(state.getCapsules());
 
 # current cost for A*
 def pelletsCost(state):
-    return Game.totalFoodAndCapsules - pelletsHeuristic(state);
+    layout = state.data.layout;
+    return layout.totalFood + layout.totalCapsules - pelletsHeuristic(state);
+
+# heuristic (remaining moves) for A*: the maze distance to the closest
+# pellet, plus a move for every other one
+def foodDistanceHeuristic(state):
+    if state.isLose():
+        return 1000.0;
+    food = state.getFood().asList();
+    if not food:
+        return 0;
+    return min([mazeDistance(state, state.getPacmanPosition(), f) for f in food]) + len(food) - 1;
+
+# the number of moves between two positions in the state's layout
+def mazeDistance(state, a, b):
+    return state.data.layout.getDistances().distance(a, b);
@@ -14,6 +14,11 @@
 
 from util import manhattanDistance
 from game import Grid
+from game import BitGrid
+from game import Actions
+from game import Configuration
+from game import Directions
+from distanceOracle import DistanceOracle
 import os
 import random
 
@@ -22,28 +27,67 @@ VISIBILITY_MATRIX_CACHE = {}
 class Layout:
     """
     A Layout manages the static information about the game board.
+
+    Layouts never change once they are loaded: the grids are frozen and the
+    lists are stored as tuples, so every game state built from a layout can
+    share it instead of copying it.
     """
 
     def __init__(self, layoutText):
         self.width = len(layoutText[0])
         self.height= len(layoutText)
-        self.walls = Grid(self.width, self.height, False)
-        self.food = Grid(self.width, self.height, False)
+        self.walls = BitGrid(self.width, self.height, False)
+        self.food = BitGrid(self.width, self.height, False)
         self.capsules = []
         self.agentPositions = []
         self.numGhosts = 0
         self.processLayoutText(layoutText)
-        self.layoutText = layoutText
-        self.totalFood = len(self.food.asList())
+        self.layoutText = tuple(layoutText)
+        self.capsules = tuple(self.capsules)
+        self.agentPositions = tuple(self.agentPositions)
+        self.walls.freeze()
+        self.food.freeze()
+        self.totalFood = self.food.count()
+        self.totalCapsules = len(self.capsules)
+        self.initializeMoveTables()
+        self.distances = None
         # self.initializeVisibilityMatrix()
 
     def getNumGhosts(self):
         return self.numGhosts
 
+    def initializeMoveTables(self):
+        """
+        Precomputes, for every open cell, the legal actions (with and without
+        Stop) and the legal neighboring cells, so the game rules can look them
+        up instead of re-reading the walls on every move.  The tables are
+        indexed by cell number x * height + y and hold None for walls.
+        """
+        numCells = self.width * self.height
+        self.legalActions = [None] * numCells
+        self.legalMoves = [None] * numCells
+        self.legalNeighbors = [None] * numCells
+        for x in range(self.width):
+            for y in range(self.height):
+                if self.walls[x][y]: continue
+                cell = x * self.height + y
+                actions = Actions.getPossibleActions(Configuration((x, y), Directions.STOP), self.walls)
+                self.legalActions[cell] = tuple(actions)
+                self.legalMoves[cell] = tuple([a for a in actions if a != Directions.STOP])
+                self.legalNeighbors[cell] = tuple(Actions.getLegalNeighbors((x, y), self.walls))
+
+    def getDistances(self):
+        """
+        The DistanceOracle of this layout, built (or loaded from the disk
+        cache) the first time it is asked for.
+        """
+        if self.distances is None:
+            self.distances = DistanceOracle.forLayout(self)
+        return self.distances
+
     def initializeVisibilityMatrix(self):
         global VISIBILITY_MATRIX_CACHE
         if reduce(str.__add__, self.layoutText) not in VISIBILITY_MATRIX_CACHE:
-            from game import Directions
             vecs = [(-0.5,0), (0.5,0),(0,-0.5),(0,0.5)]
             dirs = [Directions.NORTH, Directions.SOUTH, Directions.WEST, Directions.EAST]
             vis = Grid(self.width, self.height, {Directions.NORTH:set(), Directions.SOUTH:set(), Directions.EAST:set(), Directions.WEST:set(), Directions.STOP:set()})
@@ -90,7 +134,16 @@ class Layout:
         return "\n".join(self.layoutText)
 
     def deepCopy(self):
-        return Layout(self.layoutText[:])
+        """
+        Layouts are immutable, so a copy is the layout itself.
+        """
+        return self
+
+    def __getstate__(self):
+        # The distances are rebuilt from the cache rather than pickled
+        state = self.__dict__.copy()
+        state['distances'] = None
+        return state
 
     def processLayoutText(self, layoutText):
         """
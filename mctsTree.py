@@ -0,0 +1,301 @@
+# mctsTree.py
+# -----------
+# Array-backed search tree for MCTSAgent.
+
+"""
+MCTSTree keeps the nodes of a Monte Carlo search tree in parallel arrays
+indexed by node number instead of one object per node: the parent, the
+action leading to the node, the visit counter, the reward sum, the first
+child and the next sibling (the children of a node form a linked list), and
+a bit mask of the actions already tried from the node.  Selection is a
+single pass over the children that keeps the best UCB value, with the log
+of the parent's counter computed once.
+
+Only the root's children remember the hashes of the states they were
+sampled with, which is all that re-rooting between moves needs.
+
+Every node also keeps all-moves-as-first (AMAF) statistics for RAVE: the
+visits and reward sums of the simulations through its parent in which its
+move was played at any later point, in the tree or in the rollout.  A move
+is an action from a given pacman position, the way a move in Go is a stone
+on a given point.
+
+A tree can be capped at maxNodes nodes.  Adding a node to a full tree first
+recycles the least visited subtrees (a tenth of the cap at a time) into a
+free list; their actions count as untried again, so they can be re-expanded
+if the search comes back to them.
+"""
+
+from game import Directions
+from array import array
+import math, sys
+
+ACTIONS = [Directions.NORTH, Directions.SOUTH, Directions.EAST, Directions.WEST, Directions.STOP]
+ACTION_INDEX = dict([(a, i) for i, a in enumerate(ACTIONS)])
+NONE = -1
+FREE = -2 # parent of a recycled node
+
+class MCTSTree:
+    """
+    A tree of nodes numbered from 0, starting with only the root.  A
+    maxNodes of 0 leaves the tree unbounded.
+    """
+    def __init__(self, maxNodes=0):
+        self.maxNodes = maxNodes
+        self.free = []
+        self.inFlight = {} # node: number of virtual losses on its path
+        self.parent = array('i')
+        self.action = array('b')
+        self.counter = array('i')
+        self.rewardSum = array('d')
+        self.raveCounter = array('i')
+        self.raveSum = array('d')
+        self.firstChild = array('i')
+        self.nextSibling = array('i')
+        self.tried = array('b')
+        self.outcomes = {}
+        self.root = self.addNode(NONE, None)
+
+    def __len__(self):
+        """
+        The number of nodes in the tree, not counting recycled ones.
+        """
+        return len(self.parent) - len(self.free)
+
+    def getByteSize(self):
+        """
+        Approximately how many bytes the tree takes up.
+        """
+        total = sys.getsizeof(self.outcomes) + sys.getsizeof(self.free)
+        for column in (self.parent, self.action, self.counter, self.rewardSum, self.raveCounter, self.raveSum, self.firstChild, self.nextSibling, self.tried):
+            total += sys.getsizeof(column)
+        for hashes in self.outcomes.values():
+            total += sys.getsizeof(hashes)
+        return total
+
+    def addNode(self, parent, action):
+        """
+        Adds a child reached by action to parent (NONE for a root) and
+        returns its number.
+        """
+        if self.maxNodes and not self.free and len(self) >= self.maxNodes:
+            self.recycle(max(1, self.maxNodes / 10), parent)
+        actionIndex = NONE if action is None else ACTION_INDEX[action]
+        sibling = NONE if parent == NONE else self.firstChild[parent]
+        if self.free:
+            node = self.free.pop()
+            self.parent[node] = parent
+            self.action[node] = actionIndex
+            self.counter[node] = 0
+            self.rewardSum[node] = 0.0
+            self.raveCounter[node] = 0
+            self.raveSum[node] = 0.0
+            self.firstChild[node] = NONE
+            self.nextSibling[node] = sibling
+            self.tried[node] = 0
+        else:
+            node = len(self.parent)
+            self.parent.append(parent)
+            self.action.append(actionIndex)
+            self.counter.append(0)
+            self.rewardSum.append(0.0)
+            self.raveCounter.append(0)
+            self.raveSum.append(0.0)
+            self.firstChild.append(NONE)
+            self.nextSibling.append(sibling)
+            self.tried.append(0)
+        if parent != NONE:
+            self.firstChild[parent] = node
+        return node
+
+    def recycle(self, count, keep=NONE):
+        """
+        Frees the least visited subtrees until count nodes are freed or only
+        the root, keep, the nodes with rollouts in flight and their
+        ancestors are left.
+        """
+        protected = set([self.root])
+        for node in [keep] + self.inFlight.keys():
+            while node != NONE and node not in protected:
+                protected.add(node)
+                node = self.parent[node]
+        parent, counter = self.parent, self.counter
+        candidates = [node for node in xrange(len(parent)) if parent[node] >= 0 and node not in protected]
+        candidates.sort(key=lambda node: counter[node])
+        freed = 0
+        for node in candidates:
+            if freed >= count: break
+            # Already freed with an ancestor, or unreachable through one
+            if parent[node] == FREE: continue
+            freed += self.removeSubtree(node)
+        return freed
+
+    def removeSubtree(self, node):
+        """
+        Unlinks node from its parent, marks its action untried there and
+        puts it and its descendants on the free list.  Returns how many
+        nodes were freed.
+        """
+        parent = self.parent[node]
+        if self.firstChild[parent] == node:
+            self.firstChild[parent] = self.nextSibling[node]
+        else:
+            child = self.firstChild[parent]
+            while self.nextSibling[child] != node:
+                child = self.nextSibling[child]
+            self.nextSibling[child] = self.nextSibling[node]
+        self.tried[parent] &= ~(1 << self.action[node])
+        stack = [node]
+        freed = 0
+        while stack:
+            node = stack.pop()
+            stack.extend(self.getChildren(node))
+            self.parent[node] = FREE
+            self.outcomes.pop(node, None)
+            self.free.append(node)
+            freed += 1
+        return freed
+
+    def getAction(self, node):
+        return ACTIONS[self.action[node]]
+
+    def getChildren(self, node):
+        children = []
+        child = self.firstChild[node]
+        while child != NONE:
+            children.append(child)
+            child = self.nextSibling[child]
+        return children
+
+    def getUntriedActions(self, node, legalActions):
+        tried = self.tried[node]
+        return [a for a in legalActions if not tried & (1 << ACTION_INDEX[a])]
+
+    def markTried(self, node, action):
+        self.tried[node] |= 1 << ACTION_INDEX[action]
+
+    def select(self, node, raveEquivalence=0):
+        """
+        The child of node with the highest UCB value, or NONE if no child
+        was visited.  Children that were never visited (their rollout ran out
+        of budget) are skipped.
+
+        With a raveEquivalence k > 0, a child's mean reward is blended with
+        its AMAF mean, weighting the AMAF one by sqrt(k / (3 n + k)) for a
+        child visited n times.
+        """
+        counter, rewardSum, nextSibling = self.counter, self.rewardSum, self.nextSibling
+        raveCounter, raveSum = self.raveCounter, self.raveSum
+        # The budget can run out before the node's first rollout
+        if counter[node] == 0:
+            return NONE
+        logTotal = 2 * math.log(counter[node])
+        best, bestValue = NONE, None
+        child = self.firstChild[node]
+        while child != NONE:
+            n = counter[child]
+            if n > 0:
+                mean = rewardSum[child] / n
+                if raveEquivalence > 0 and raveCounter[child] > 0:
+                    beta = math.sqrt(raveEquivalence / (3.0 * n + raveEquivalence))
+                    mean = (1 - beta) * mean + beta * raveSum[child] / raveCounter[child]
+                value = mean + math.sqrt(logTotal / n)
+                if best == NONE or value > bestValue:
+                    best, bestValue = child, value
+            child = nextSibling[child]
+        return best
+
+    def backUp(self, node, reward):
+        parent, counter, rewardSum = self.parent, self.counter, self.rewardSum
+        while node != NONE:
+            counter[node] += 1
+            rewardSum[node] += reward
+            node = parent[node]
+
+    def backUpAMAF(self, node, reward, positions, playedMoves):
+        """
+        Adds reward to the AMAF statistics of the children of every node on
+        the path from node to the root whose move was played below that
+        node.  positions holds the pacman positions along the path, from the
+        root down to node, and playedMoves the (position, action index)
+        moves of the rollout from node.
+        """
+        parent, action, raveCounter, raveSum, nextSibling = self.parent, self.action, self.raveCounter, self.raveSum, self.nextSibling
+        playedMoves = set(playedMoves)
+        depth = len(positions) - 1
+        while node != NONE:
+            position = positions[depth]
+            child = self.firstChild[node]
+            while child != NONE:
+                if (position, action[child]) in playedMoves:
+                    raveCounter[child] += 1
+                    raveSum[child] += reward
+                child = nextSibling[child]
+            if depth > 0:
+                playedMoves.add((positions[depth - 1], action[node]))
+            depth -= 1
+            node = parent[node]
+
+    def addVirtualLoss(self, node, loss):
+        """
+        Counts a visit with a reward of -loss on the path from node to the
+        root, to steer other threads away from it until removeVirtualLoss.
+        """
+        self.inFlight[node] = self.inFlight.get(node, 0) + 1
+        parent, counter, rewardSum = self.parent, self.counter, self.rewardSum
+        while node != NONE:
+            counter[node] += 1
+            rewardSum[node] -= loss
+            node = parent[node]
+
+    def removeVirtualLoss(self, node, loss):
+        self.inFlight[node] -= 1
+        if self.inFlight[node] == 0:
+            del self.inFlight[node]
+        parent, counter, rewardSum = self.parent, self.counter, self.rewardSum
+        while node != NONE:
+            counter[node] -= 1
+            rewardSum[node] += loss
+            node = parent[node]
+
+    def addOutcome(self, node, stateHash):
+        """
+        Records that a child of the root was sampled with the state hashed.
+        """
+        if self.parent[node] == self.root:
+            self.outcomes.setdefault(node, set()).add(stateHash)
+
+    def findChild(self, action, stateHash):
+        """
+        The child of the root reached by action that was sampled with the
+        state hashed, or NONE.
+        """
+        for child in self.getChildren(self.root):
+            if self.getAction(child) == action and stateHash in self.outcomes.get(child, ()):
+                return child
+        return NONE
+
+    def subtree(self, node, shift=0.0):
+        """
+        A new tree holding the subtree rooted at node, with shift taken off
+        every reward.  Nodes that were never visited are dropped, and only
+        the actions of the children kept count as tried.
+        """
+        tree = MCTSTree()
+        tree.counter[tree.root] = self.counter[node]
+        tree.rewardSum[tree.root] = self.rewardSum[node] - shift * self.counter[node]
+        stack = [(node, tree.root)]
+        while stack:
+            old, new = stack.pop()
+            for child in reversed(self.getChildren(old)):
+                n = self.counter[child]
+                if n == 0: continue
+                copy = tree.addNode(new, self.getAction(child))
+                tree.tried[new] |= 1 << self.action[child]
+                tree.counter[copy] = n
+                tree.rewardSum[copy] = self.rewardSum[child] - shift * n
+                tree.raveCounter[copy] = self.raveCounter[child]
+                tree.raveSum[copy] = self.raveSum[child] - shift * self.raveCounter[child]
+                stack.append((child, copy))
+        tree.maxNodes = self.maxNodes
+        return tree
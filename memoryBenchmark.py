@@ -0,0 +1,73 @@
+# memoryBenchmark.py
+# ------------------
+# Measures how much memory the successor states of a game take up.
+
+"""
+Estimates the number of bytes each GameState made by generatePacmanSuccessor
+adds, the way a search tree holding on to its states would see it.  Objects
+shared with the initial state (the layout, the initial food grid, ...) are
+not counted against the successors.
+
+  python memoryBenchmark.py
+  python memoryBenchmark.py -l originalClassic -n 5000
+"""
+
+from game import Game
+import pacman, layout
+import sys, types, random
+
+def objectSize(obj, seen):
+    """
+    Returns the bytes taken by obj and everything reachable from it that is
+    not already in seen, adding what it visits to seen.
+    """
+    total = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen: continue
+        if isinstance(obj, (types.ModuleType, types.ClassType, type, types.FunctionType, types.MethodType)): continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        if hasattr(obj, '__dict__'):
+            stack.append(obj.__dict__)
+        for slot in getattr(type(obj), '__slots__', ()):
+            if hasattr(obj, slot): stack.append(getattr(obj, slot))
+    return total
+
+def bytesPerState(layoutName, numStates, numGhosts=4, depth=10):
+    """
+    Builds numStates successor states with random rollouts of the given
+    depth from the start of the layout and returns the average number of
+    bytes each of them adds.
+    """
+    Game.maxIterations = Game.currentIterations = numStates + 1
+    root = pacman.GameState()
+    root.initialize(layout.getLayout(layoutName), numGhosts)
+    states = []
+    while len(states) < numStates:
+        state = root
+        for i in range(depth):
+            if state.isWin() or state.isLose() or len(states) == numStates: break
+            state = state.generatePacmanSuccessor(random.choice(state.getLegalPacmanActions()))
+            states.append(state)
+    seen = set()
+    objectSize(root, seen)
+    return float(sum([objectSize(state, seen) for state in states])) / len(states)
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option('-l', '--layout', dest='layouts', action='append',
+                      help='the layouts to measure [Default: mediumClassic and originalClassic]')
+    parser.add_option('-n', '--numStates', dest='numStates', type='int', default=2000,
+                      help='the number of successor states to build [Default: %default]')
+    options, otherjunk = parser.parse_args()
+    random.seed('cs188')
+    for name in options.layouts or ['mediumClassic', 'originalClassic']:
+        print '%-16s %7.1f bytes/state' % (name, bytesPerState(name, options.numStates))
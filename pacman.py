@@ -44,10 +44,11 @@ from game import GameStateData
 from game import Game
 from game import Directions
 from game import Actions
+from game import Configuration
 from util import nearestPoint
 from util import manhattanDistance
 import util, layout
-import sys, types, time, random, os
+import sys, types, time, random, os, multiprocessing
 
 ###################################################
 # YOUR INTERFACE TO THE PACMAN WORLD: A GameState #
@@ -68,6 +69,12 @@ class GameState:
     Note that in classic Pacman, Pacman is always agent 0.
     """
 
+    # The SuccessorCache in front of generatePacmanSuccessor, if enabled
+    successorCache = None
+
+    # Set by freeze; copies and successors of a frozen state are not frozen
+    frozen = False
+
     ####################################################
     # Accessor methods: use these to access state data #
     ####################################################
@@ -92,32 +99,13 @@ class GameState:
 
         # Copy current state
         state = GameState(self)
-
-        # Let agent's logic deal with its action's effects on the board
-        if agentIndex == 0:  # Pacman is moving
-            state.data._eaten = [False for i in range(state.getNumAgents())]
-            PacmanRules.applyAction( state, action )
-        else:                # A ghost is moving
-            GhostRules.applyAction( state, action, agentIndex )
-
-        # Time passes
-        if agentIndex == 0:
-            state.data.scoreChange += -TIME_PENALTY # Penalty for waiting around
-        else:
-            GhostRules.decrementTimer( state.data.agentStates[agentIndex] )
-
-        # Resolve multi-agent effects
-        GhostRules.checkDeath( state, agentIndex )
-
-        # Book keeping
-        state.data._agentMoved = agentIndex
-        state.data.score += state.data.scoreChange
+        state.applyAction( agentIndex, action )
+        state.data._hash = state.data.updateHash( self.data )
         return state
 
     def getLegalPacmanActions( self ):
-        actions = self.getLegalActions( 0 )
-        if Directions.STOP in actions: actions.remove(Directions.STOP)
-        return actions
+        if self.isWin() or self.isLose(): return []
+        return Actions.getLegalMoves( self.data.agentStates[0].configuration, self.data.layout )
 
     def getAllPossibleActions( self ):
         return [Directions.NORTH, Directions.SOUTH, Directions.EAST, Directions.WEST];
@@ -128,24 +116,44 @@ class GameState:
             return 1;
         return 0;
 
-    def generatePacmanSuccessor( self, action ):
+    def generatePacmanSuccessor( self, action, seed=None ):
         if not self.checkLegalAction(action):
             action = Directions.STOP;
+        cache = GameState.successorCache
+        if cache is not None:
+            if seed is None: seed = cache.seed
+            successor = cache.get(self, action, seed)
+            if successor is not None:
+                Game.currentIterations -= cache.hitCost
+                if Game.currentIterations <= 0:
+                    return None
+                return successor
         Game.currentIterations -= 1
         if Game.currentIterations <= 0:
             return None
         """
-        Generates the successor state after the specified pacman move
+        Generates the successor state after the specified pacman move and one
+        random legal move by each ghost.  The whole ply is applied to a single
+        copy of this state, which ends up equal to the one chaining
+        generateSuccessor for every agent would give.
+
+        Given a seed, the ghost moves are drawn from a generator seeded by the
+        state, action and seed instead of the random module, so the same call
+        always gives the same successor.
         """
-        newState = self.generateSuccessor(0, action)
-        for i in range(1,self.getNumAgents()):
-            actions = newState.getLegalActions(i)
-            if newState.isWin() or newState.isLose():
-                break;
-            if len(actions) > 0:
-                newState = newState.generateSuccessor(i, actions[random.randint(0, len(actions) - 1)])
-            else:
-                newState = newState.generateSuccessor(i, Directions.STOP)
+        if self.isWin() or self.isLose(): raise Exception('Can\'t generate a successor of a terminal state.')
+        newState = GameState(self)
+        if seed is None:
+            newState.applyPly(action)
+        else:
+            newState.applyPly(action, random.Random(hash((hash(self), action, seed))))
+        newState.data._hash = newState.data.updateHash( self.data )
+        if newState.data._agentMoved != 0:
+            # A ghost moved last, so nothing was eaten in the last move
+            newState.data._foodEaten = None
+            newState.data._capsuleEaten = None
+        if cache is not None:
+            cache.add(self, action, seed, newState)
         return newState
 
     def getPacmanState( self ):
@@ -189,7 +197,7 @@ class GameState:
         return self.data.capsules
 
     def getNumFood( self ):
-        return self.data.food.count()
+        return self.data.numFood
 
     def getFood(self):
         """
@@ -246,6 +254,64 @@ class GameState:
         state.data = self.data.deepCopy()
         return state
 
+    def freeze( self ):
+        """
+        Makes the state read-only: actions can't be applied to it in place,
+        and writing to its data, agent states, food or lists (capsules,
+        agent states and eaten ghosts) raises an exception.  The lists still
+        compare equal to those of unfrozen states.  Configurations are shared
+        between states and never changed in place, by convention.
+        Copies and successors of a frozen state can be written.  This is how
+        Game.run shows agents the state of the game without copying it.
+        """
+        if self.frozen: return
+        self.frozen = True
+        self.data.freeze()
+
+    def applyAction( self, agentIndex, action ):
+        """
+        Applies the specified agent's action to this state in place.  The
+        state's hash is left for the caller to update.
+        """
+        if self.frozen: raise Exception('Can\'t apply an action to a frozen state')
+        self.data.scoreChange = 0
+
+        # Let agent's logic deal with its action's effects on the board
+        if agentIndex == 0:  # Pacman is moving
+            self.data._eaten = [False for i in range(self.getNumAgents())]
+            PacmanRules.applyAction( self, action )
+        else:                # A ghost is moving
+            GhostRules.applyAction( self, action, agentIndex )
+
+        # Time passes
+        if agentIndex == 0:
+            self.data.scoreChange += -TIME_PENALTY # Penalty for waiting around
+        else:
+            GhostRules.decrementTimer( self.data.agentStates[agentIndex] )
+
+        # Resolve multi-agent effects
+        GhostRules.checkDeath( self, agentIndex )
+
+        # Book keeping
+        self.data._agentMoved = agentIndex
+        self.data.score += self.data.scoreChange
+
+    def applyPly( self, action, ghostRandom=random ):
+        """
+        Applies pacman's action and then a random legal action for each ghost
+        to this state in place, stopping early if the game ends.  Ghost moves
+        are drawn from ghostRandom.
+        """
+        self.applyAction(0, action)
+        for i in range(1,self.getNumAgents()):
+            actions = self.getLegalActions(i)
+            if self.isWin() or self.isLose():
+                break;
+            if len(actions) > 0:
+                self.applyAction(i, actions[ghostRandom.randint(0, len(actions) - 1)])
+            else:
+                self.applyAction(i, Directions.STOP)
+
     def __eq__( self, other ):
         """
         Allows two states to be compared.
@@ -268,6 +334,125 @@ class GameState:
         """
         self.data.initialize(layout, numGhostAgents)
 
+class SearchState(GameState):
+    """
+    A GameState that a search agent can walk forward and back in place
+    instead of allocating a new state for every step.
+
+    makeMove applies a full ply, exactly as generatePacmanSuccessor would,
+    and unmakeMove undoes the most recent ply that has not been undone yet,
+    restoring the agents, food, capsules, score, flags and hash.  To keep a
+    position around, copy it with GameState(searchState).
+    """
+
+    def __init__( self, state ):
+        GameState.__init__( self, state )
+        self.data._win = state.data._win
+        self.data._lose = state.data._lose
+        self.data._hash = state.data._hash
+        self.history = []
+
+    def makeMove( self, action ):
+        """
+        Applies the pacman action and a random move for each ghost.  Like
+        generatePacmanSuccessor this is charged against the forward model
+        budget; returns False, without changing the state, once it runs out.
+        """
+        if not self.checkLegalAction(action):
+            action = Directions.STOP;
+        Game.currentIterations -= 1
+        if Game.currentIterations <= 0:
+            return False
+        if self.isWin() or self.isLose(): raise Exception('Can\'t generate a successor of a terminal state.')
+
+        data = self.data
+        agents = data.getAgentSnapshot()
+        self.history.append( (agents, data.food, data.numFood, data.capsules, data.score, data.scoreChange,
+                              data._eaten, data._foodEaten, data._foodAdded, data._capsuleEaten, data._agentMoved, data._hash) )
+
+        data._foodEaten = None
+        data._foodAdded = None
+        data._capsuleEaten = None
+        prevScore, prevHash = data.score, data._hash
+        self.applyPly(action)
+
+        # Same bookkeeping as generatePacmanSuccessor, done against the saved values
+        data._hash = data.updateHashFrom( prevHash, prevScore, agents )
+        if data._agentMoved != 0:
+            data._foodEaten = None
+            data._capsuleEaten = None
+        return True
+
+    def unmakeMove( self ):
+        """
+        Undoes the last ply applied by makeMove.
+        """
+        data = self.data
+        (agents, data.food, data.numFood, data.capsules, data.score, data.scoreChange,
+         data._eaten, data._foodEaten, data._foodAdded, data._capsuleEaten, data._agentMoved, data._hash) = self.history.pop()
+        for agentState, (configuration, scaredTimer) in zip( data.agentStates, agents ):
+            agentState.configuration = configuration
+            agentState.scaredTimer = scaredTimer
+        # Moves can't be made from terminal states, so the state we go back to wasn't one
+        data._win = False
+        data._lose = False
+
+    def getDepth( self ):
+        """
+        Returns the number of plies that can still be undone.
+        """
+        return len( self.history )
+
+class SuccessorCache:
+    """
+    An LRU cache in front of GameState.generatePacmanSuccessor, turned on
+    with --successorCache.  Entries are keyed by the state's hash, pacman's
+    action and the ghost-model seed, and are checked against the full state,
+    so a hash collision can't return the wrong successor.
+
+    While the cache is on, ghost moves are always drawn from a generator
+    seeded by the state, action and seed, which is what makes a successor
+    worth caching: the same state, action and seed give the same successor.
+    Calls that don't pass a seed use the cache's own, which the game rules
+    reseed after every pacman move.  So the cache changes the ghost model:
+    within one move a state and action have a single ghost response, drawn
+    at random, where without the cache every call draws a new one; from
+    move to move, and game to game, the responses change.
+
+    Charging against Game.currentIterations: a miss costs one iteration as
+    usual and a hit costs hitCost iterations.  The default of 1 makes the
+    cache save time but not budget; a smaller cost makes hits cheaper.  It
+    has to stay above 0, or agents that search until generatePacmanSuccessor
+    returns None would never stop once everything they try is cached.  Like
+    a miss, a hit returns None once the budget has run out.
+    """
+    def __init__( self, maxSize, hitCost=1.0, seed=None ):
+        if hitCost <= 0: raise Exception('Cache hits must cost more than 0 iterations')
+        self.entries = util.LRUCache( maxSize )
+        self.hitCost = hitCost
+        self.hits = 0
+        self.misses = 0
+        self.reseed( seed )
+
+    def reseed( self, seed=None ):
+        """
+        Changes the seed used by calls that don't pass one, so they see new
+        ghost moves; a random one if seed is None.
+        """
+        if seed is None: seed = random.randint( 0, sys.maxint )
+        self.seed = seed
+
+    def get( self, state, action, seed ):
+        entry = self.entries.get( (hash(state), action, seed) )
+        if entry is not None and entry[0] == state:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return None
+
+    def add( self, state, action, seed, successor ):
+        self.entries[(hash(state), action, seed)] = (state, successor)
+
 ############################################################################
 #                     THE HIDDEN SECRETS OF PACMAN                         #
 #                                                                          #
@@ -302,6 +487,9 @@ class ClassicGameRules:
         """
         if state.isWin(): self.win(state, game)
         if state.isLose(): self.lose(state, game)
+        # The next pacman move samples new ghost moves from the cache
+        if state.data._agentMoved == 0 and GameState.successorCache is not None:
+            GameState.successorCache.reseed()
 
     def win( self, state, game ):
         if not self.quiet: print "Pacman emerges victorious! Score: %d" % state.data.score
@@ -346,7 +534,7 @@ class PacmanRules:
         """
         Returns a list of possible actions.
         """
-        return Actions.getPossibleActions( state.getPacmanState().configuration, state.data.layout.walls )
+        return Actions.getLegalActions( state.data.agentStates[0].configuration, state.data.layout )
     getLegalActions = staticmethod( getLegalActions )
 
     def applyAction( state, action ):
@@ -378,14 +566,14 @@ class PacmanRules:
             state.data.scoreChange += 10
             state.data.food = state.data.food.copy()
             state.data.food[x][y] = False
+            state.data.numFood -= 1
             state.data._foodEaten = position
-            # TODO: cache numFood?
-            numFood = state.getNumFood()
-            if numFood == 0 and not state.data._lose:
+            if state.data.numFood == 0 and not state.data._lose:
                 state.data.scoreChange += 500
                 state.data._win = True
         # Eat capsule
         if( position in state.getCapsules() ):
+            state.data.capsules = list(state.data.capsules)
             state.data.capsules.remove( position )
             state.data._capsuleEaten = position
             # Reset all ghosts' scared timers
@@ -404,10 +592,8 @@ class GhostRules:
         reach a dead end, but can turn 90 degrees at intersections.
         """
         conf = state.getGhostState( ghostIndex ).configuration
-        possibleActions = Actions.getPossibleActions( conf, state.data.layout.walls )
+        possibleActions = Actions.getLegalMoves( conf, state.data.layout )
         reverse = Actions.reverseDirection( conf.direction )
-        if Directions.STOP in possibleActions:
-            possibleActions.remove( Directions.STOP )
         if reverse in possibleActions and len( possibleActions ) > 1:
             possibleActions.remove( reverse )
         return possibleActions
@@ -429,7 +615,8 @@ class GhostRules:
     def decrementTimer( ghostState):
         timer = ghostState.scaredTimer
         if timer == 1:
-            ghostState.configuration.pos = nearestPoint( ghostState.configuration.pos )
+            conf = ghostState.configuration
+            ghostState.configuration = Configuration.intern( nearestPoint( conf.pos ), conf.direction )
         ghostState.scaredTimer = max( 0, timer - 1 )
     decrementTimer = staticmethod( decrementTimer )
 
@@ -453,7 +640,9 @@ class GhostRules:
             state.data.scoreChange += 200
             GhostRules.placeGhost(state, ghostState)
             ghostState.scaredTimer = 0
-            # Added for first-person
+            # Added for first-person; the list is shared with the state this
+            # one was generated from, so it is copied before writing
+            state.data._eaten = list(state.data._eaten)
             state.data._eaten[agentIndex] = True
         else:
             if not state.data._win:
@@ -540,6 +729,14 @@ def readCommand( argv ):
                       help=default('Maximum length of time an agent can spend computing in a single game'), default=30)
     parser.add_option('-i', '--iterations', dest='iterations', type='int',
                       help=default('Maximum length of forward model steps'), default=500)
+    parser.add_option('--successorCache', dest='successorCache', type='int',
+                      help=default('Number of pacman successors to cache; 0 turns the cache off'), default=0)
+    parser.add_option('--cacheHitCost', dest='cacheHitCost', type='float',
+                      help=default('Forward model steps charged for a cached successor; must be above 0'), default=1.0)
+    parser.add_option('--workers', dest='workers', type='int',
+                      help=default('Number of processes to play games in; above 1, every game gets its own seed and nothing is displayed'), default=1)
+    parser.add_option('--copyObservations', action='store_true', dest='copyObservations',
+                      help='Shows agents a deep copy of the state every turn instead of the state itself, made read-only', default=False)
 
     options, otherjunk = parser.parse_args(argv)
     if len(otherjunk) != 0:
@@ -587,10 +784,14 @@ def readCommand( argv ):
     args['record'] = options.record
     args['catchExceptions'] = options.catchExceptions
     args['timeout'] = options.timeout
+    args['workers'] = options.workers
 
     Game.maxIterations = options.iterations
     Game.currentIterations = Game.maxIterations
     Game.timeLimit = options.timeout
+    Game.copyObservations = options.copyObservations
+    if options.successorCache > 0:
+        GameState.successorCache = SuccessorCache(options.successorCache, options.cacheHitCost)
 
     # Special case: recorded games don't use the runGames method or args structure
     if options.gameToReplay != None:
@@ -646,7 +847,98 @@ def replayGame( layout, actions, display ):
 
     display.finish()
 
-def runGames( layout, pacman, ghosts, display, numGames, record=False, numTraining = 0, catchExceptions=False, timeout=30 ):
+def recordGame( layout, moveHistory, i ):
+    import time, cPickle
+    fname = ('recorded-game-%d' % (i + 1)) +  '-'.join([str(t) for t in time.localtime()[1:6]])
+    f = file(fname, 'w')
+    components = {'layout': layout, 'actions': moveHistory}
+    cPickle.dump(components, f)
+    f.close()
+
+def printSummary( scores, wins ):
+    winRate = wins.count(True)/ float(len(wins))
+    print 'Average Score:', sum(scores) / float(len(scores))
+    print 'Scores:       ', ', '.join([str(score) for score in scores])
+    print 'Win Rate:      %d/%d (%.2f)' % (wins.count(True), len(wins), winRate)
+    print 'Record:       ', ', '.join([ ['Loss', 'Win'][int(w)] for w in wins])
+
+# The game components of a worker process in runParallelGames
+gameComponents = None
+
+def initGameWorker(components):
+    global gameComponents
+    gameComponents = components
+
+def gameWorker(job):
+    """
+    Plays game number i with its own seed in a worker process and returns
+    (i, final state, move history, cache hits, cache misses), the cache
+    counts being this game's share.
+    """
+    i, seed = job
+    layout, pacman, ghosts, catchExceptions, timeout = gameComponents
+    import textDisplay
+    random.seed(seed)
+    rules = ClassicGameRules(timeout)
+    cache = GameState.successorCache
+    if cache is not None:
+        hits, misses = cache.hits, cache.misses
+    game = rules.newGame( layout, pacman, ghosts, textDisplay.NullGraphics(), True, catchExceptions)
+    game.run()
+    if cache is not None:
+        hits, misses = cache.hits - hits, cache.misses - misses
+    else:
+        hits, misses = 0, 0
+    return i, game.state, game.moveHistory, hits, misses
+
+def runParallelGames( layout, pacman, ghosts, numGames, record, numTraining, catchExceptions, timeout, workers ):
+    """
+    Plays the games in a pool of worker processes, each with a copy of the
+    agents.  Game i is seeded from its index and a base seed drawn from the
+    random module, so with --fixRandomSeed a run plays the same games
+    whatever the number of workers (though not the games of a sequential
+    run).  Results are printed as games finish; the summary lists them in
+    game order.  Agents can't start worker processes of their own here.
+
+    Like runGames, returns the games that weren't training games, in
+    order.  They are rebuilt from the workers' final states and move
+    histories, with this process's agents and no display, so they can be
+    read but not run again.
+    """
+    baseSeed = random.getrandbits(32)
+    jobs = [(i, '%d-%d' % (baseSeed, i)) for i in range(numGames)]
+    components = (layout, pacman, ghosts, catchExceptions, timeout)
+    pool = multiprocessing.Pool(workers, initGameWorker, (components,))
+    rules = ClassicGameRules(timeout)
+    agents = [pacman] + ghosts[:layout.getNumGhosts()]
+    games = {}
+    hits, misses = 0, 0
+    try:
+        for i, state, moveHistory, gameHits, gameMisses in pool.imap_unordered(gameWorker, jobs):
+            hits += gameHits
+            misses += gameMisses
+            if record: recordGame(layout, moveHistory, i)
+            if i < numTraining: continue
+            print 'Game %d: %s, score %d' % (i + 1, ['Loss', 'Win'][int(state.isWin())], state.getScore())
+            game = Game(agents, None, rules, catchExceptions=catchExceptions)
+            game.state = state
+            game.moveHistory = moveHistory
+            game.gameOver = True
+            games[i] = game
+    finally:
+        pool.terminate()
+
+    games = [games[i] for i in sorted(games)]
+    if games:
+        printSummary([game.state.getScore() for game in games], [game.state.isWin() for game in games])
+        if GameState.successorCache is not None:
+            print 'Cache:         %d hits, %d misses' % (hits, misses)
+    return games
+
+def runGames( layout, pacman, ghosts, display, numGames, record=False, numTraining = 0, catchExceptions=False, timeout=30, workers=1 ):
+    if workers > 1:
+        return runParallelGames( layout, pacman, ghosts, numGames, record, numTraining, catchExceptions, timeout, workers )
+
     import __main__
     __main__.__dict__['_display'] = display
 
@@ -667,22 +959,15 @@ def runGames( layout, pacman, ghosts, display, numGames, record=False, numTraini
         game.run()
         if not beQuiet: games.append(game)
 
-        if record:
-            import time, cPickle
-            fname = ('recorded-game-%d' % (i + 1)) +  '-'.join([str(t) for t in time.localtime()[1:6]])
-            f = file(fname, 'w')
-            components = {'layout': layout, 'actions': game.moveHistory}
-            cPickle.dump(components, f)
-            f.close()
+        if record: recordGame(layout, game.moveHistory, i)
 
     if (numGames-numTraining) > 0:
         scores = [game.state.getScore() for game in games]
         wins = [game.state.isWin() for game in games]
-        winRate = wins.count(True)/ float(len(wins))
-        print 'Average Score:', sum(scores) / float(len(scores))
-        print 'Scores:       ', ', '.join([str(score) for score in scores])
-        print 'Win Rate:      %d/%d (%.2f)' % (wins.count(True), len(wins), winRate)
-        print 'Record:       ', ', '.join([ ['Loss', 'Win'][int(w)] for w in wins])
+        printSummary(scores, wins)
+        cache = GameState.successorCache
+        if cache is not None:
+            print 'Cache:         %d hits, %d misses' % (cache.hits, cache.misses)
 
     return games
 
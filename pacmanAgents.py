@@ -13,10 +13,72 @@
 
 
 from pacman import Directions
+from pacman import GameState
+from pacman import SearchState
 from game import Agent
+from game import Game
+from game import ZobristKeys
 from heuristics import *
+# These two need NumPy, but import without it and only raise when a
+# simulator or planner is made, so NumPy stays optional for other agents
+from batchSimulator import BatchSimulator, DIRECTIONS, affordableGames
+from geneticPlanner import GeneticPlanner
+from mctsTree import MCTSTree, NONE, ACTIONS, ACTION_INDEX
+import util
 import random
 import math
+import multiprocessing
+import threading
+import heapq
+import time
+
+class RolloutTrie:
+    """
+    The states reached from a root state by the action sequences played
+    from it during one move, in a trie keyed by action, so sequences sharing
+    a prefix only simulate their own suffix.  Illegal actions are stored as
+    Stop, which is what generatePacmanSuccessor plays for them.
+
+    Like SuccessorCache hits, going down an existing edge still costs
+    hitCost iterations of the budget; agents that search until the budget
+    runs out would never stop otherwise.
+    """
+    class Node(object):
+        __slots__ = ('state', 'children', 'evaluation')
+
+        def __init__(self, state):
+            self.state = state
+            self.children = {}
+            self.evaluation = None
+
+        def getEvaluation(self):
+            if self.evaluation is None:
+                self.evaluation = scoreEvaluation(self.state)
+            return self.evaluation
+
+    def __init__(self, root, hitCost=0.1):
+        if hitCost <= 0: raise Exception('hitCost must be positive, or a search could loop forever')
+        self.root = self.Node(root)
+        self.hitCost = hitCost
+
+    def getChild(self, node, action):
+        """
+        The node action leads to from node, or None once the budget runs
+        out.
+        """
+        if not node.state.checkLegalAction(action):
+            action = Directions.STOP
+        child = node.children.get(action)
+        if child is not None:
+            Game.currentIterations -= self.hitCost
+            if Game.currentIterations <= 0:
+                return None
+            return child
+        state = node.state.generatePacmanSuccessor(action)
+        if state is None:
+            return None
+        child = node.children[action] = self.Node(state)
+        return child
 
 class RandomAgent(Agent):
     # Initialization Function: Called one time when the game starts
@@ -44,15 +106,40 @@ class RandomSequenceAgent(Agent):
         possible = state.getAllPossibleActions();
         for i in range(0,len(self.actionList)):
             self.actionList[i] = possible[random.randint(0,len(possible)-1)];
-        tempState = state;
+        tempState = SearchState(state);
         for i in range(0,len(self.actionList)):
             if tempState.isWin() + tempState.isLose() == 0:
-                tempState = tempState.generatePacmanSuccessor(self.actionList[i]);
+                if not tempState.makeMove(self.actionList[i]):
+                    break;
             else:
                 break;
         # returns random action from all the valide actions
         return self.actionList[0];
 
+class BatchRolloutAgent(Agent):
+    # Scores every legal action by the average of many random rollouts,
+    # played side by side in a BatchSimulator (needs NumPy).  Every ply of
+    # every rollout costs an iteration of the budget, so each action gets
+    # as many rollouts as the budget pays for, up to numRollouts
+    def __init__(self, numRollouts=256, depth=5):
+        self.numRollouts = int(numRollouts)
+        self.depth = int(depth)
+
+    # GetAction Function: Called with every frame
+    def getAction(self, state):
+        legal = state.getLegalPacmanActions()
+        numRollouts = affordableGames(self.numRollouts * len(legal), self.depth) / len(legal)
+        if numRollouts == 0:
+            return random.choice(legal)
+        simulator = BatchSimulator(state, numRollouts * len(legal), random.randint(0, 2147483647))
+        firstActions = []
+        for action in legal:
+            firstActions += [action] * numRollouts
+        values = simulator.randomRollouts(firstActions, self.depth)
+        Game.currentIterations -= numRollouts * len(legal) * self.depth
+        scored = [(values[i * numRollouts:(i + 1) * numRollouts].mean(), action) for i, action in enumerate(legal)]
+        return max(scored)[1]
+
 class GreedyAgent(Agent):
     # Initialization Function: Called one time when the game starts
     def registerInitialState(self, state):
@@ -74,6 +161,19 @@ class GreedyAgent(Agent):
         return random.choice(bestActions)
 
 class HillClimberAgent(Agent):
+    # prefixCache plays the action lists through a RolloutTrie, where
+    # revisiting a prefix costs hitCost iterations.  climbers > 1 runs that
+    # many climbs from different random starts in a pool of workers
+    # processes (as many as climbers by default), each with an even share
+    # of the budget.  report prints how every climb went after each move
+    def __init__(self, prefixCache=False, hitCost=0.1, climbers=1, workers=0, report=False):
+        self.prefixCache = util.parseBool(prefixCache)
+        self.hitCost = float(hitCost)
+        self.climbers = int(climbers)
+        self.workers = int(workers) or self.climbers
+        self.report = util.parseBool(report)
+        self.pool = None
+
     # Initialization Function: Called one time when the game starts
     def registerInitialState(self, state):
         self.actionList = []
@@ -83,19 +183,43 @@ class HillClimberAgent(Agent):
 
     # GetAction Function: Called with every frame
     def getAction(self, state):
+        if self.climbers > 1:
+            return self.parallelClimb(state)
+        maxScore, maxActionList, tried, found = self.climb(state)
+        if self.report:
+            print 'Climber: best %.1f after %d of %d action lists' % (maxScore, found, tried)
+        return maxActionList[0]
+
+    # Climbs from a random start until the budget runs out.  Returns the
+    # best score, its action list, the number of action lists tried and the
+    # one at which the best was found
+    def climb(self, state):
         possible = state.getAllPossibleActions()
         for i in range(0,len(self.actionList)):
             self.actionList[i] = possible[random.randint(0,len(possible)-1)]
         maxScore = -2147483648
         maxActionList = self.actionList[:]
+        tried = found = 0
+        trie = None
+        if self.prefixCache:
+            trie = RolloutTrie(state, self.hitCost)
         tempState = state          
         while True:
+            tried += 1
             tempState = state
             tempScore = -2147483648
+            node = trie and trie.root
             for i in range(0,len(self.actionList)):
-                tempScore = scoreEvaluation(tempState)
+                if node is None:
+                    tempScore = scoreEvaluation(tempState)
+                else:
+                    tempScore = node.getEvaluation()
                 if tempState.isWin() + tempState.isLose() == 0:
-                    tempState = tempState.generatePacmanSuccessor(self.actionList[i])
+                    if trie is None:
+                        tempState = tempState.generatePacmanSuccessor(self.actionList[i])
+                    else:
+                        node = trie.getChild(node, self.actionList[i])
+                        tempState = node and node.state
                     if not tempState:
                         # generatePacmanSuccessor has been called maximum times
                         break
@@ -104,11 +228,34 @@ class HillClimberAgent(Agent):
             if tempScore > maxScore:
                 maxScore = tempScore
                 maxActionList = self.actionList[:]
+                found = tried
             if not tempState:
                 # generatePacmanSuccessor has been called maximum times
                 break
             self.changeActionList(tempState)
-        return maxActionList[0]
+        return (maxScore, maxActionList, tried, found)
+
+    # Runs the climbers in the pool and picks the first action with the best
+    # score any climber found, breaking ties by how many climbers ended on it
+    def parallelClimb(self, state):
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.workers)
+        jobs = []
+        for share in util.splitBudget(Game.currentIterations, self.climbers):
+            jobs.append((state, share, random.randint(0, 2147483647), self.prefixCache, self.hitCost))
+        results = {}
+        for i, (maxScore, maxActionList, tried, found, used) in enumerate(self.pool.map(climbWorker, jobs)):
+            Game.currentIterations -= used
+            if self.report:
+                print 'Climber %d: best %.1f after %d of %d action lists' % (i, maxScore, found, tried)
+            score, count = results.get(maxActionList[0], (maxScore, 0))
+            results[maxActionList[0]] = (max(score, maxScore), count + 1)
+        return max([(result, action) for action, result in results.items()])[1]
+
+    # Called when the game is over
+    def final(self, state):
+        util.closePools(self.pool)
+        self.pool = None
         
     def changeActionList(self, state):
         possible = state.getAllPossibleActions()
@@ -116,14 +263,37 @@ class HillClimberAgent(Agent):
             if (random.randint(0, 9) < 5):
                 self.actionList[i] = possible[random.randint(0,len(possible)-1)]
 
+# Runs in a worker process of HillClimberAgent.parallelClimb: one climb with
+# its own seed and budget share.  Returns what HillClimberAgent.climb does
+# and the number of iterations used
+def climbWorker(job):
+    state, budget, seed, prefixCache, hitCost = job
+    random.seed(seed)
+    Game.currentIterations = budget
+    agent = HillClimberAgent(prefixCache, hitCost)
+    agent.registerInitialState(state)
+    return agent.climb(state) + (budget - Game.currentIterations,)
+
 class GeneticAgent(Agent):
+    # workers > 1 evaluates the population in that many worker processes,
+    # each with the root state and an even share of the budget for the move.
+    # prefixCache plays the chromosomes through a RolloutTrie (one per
+    # worker), where revisiting a prefix costs hitCost iterations
+    def __init__(self, populationSize=8, workers=1, prefixCache=False, hitCost=0.1):
+        self.populationSize = int(populationSize)
+        self.workers = int(workers)
+        self.prefixCache = util.parseBool(prefixCache)
+        self.hitCost = float(hitCost)
+        self.pools = None
+        self.trie = None
+
     # Initialization Function: Called one time when the game starts
     def registerInitialState(self, state):
         defaultChromosome = []
         for i in range(0, 5):
             defaultChromosome.append(Directions.STOP)
         self.chromosomes = []
-        for i in range(0, 8):
+        for i in range(0, self.populationSize):
             self.chromosomes.append(defaultChromosome[:])
         return
     
@@ -132,30 +302,54 @@ class GeneticAgent(Agent):
         if not len(self.fitness):
             return None
         sum = 0
-        value = random.randint(0, 35)
-        for i in range(0, 8):
+        value = random.randint(0, len(self.fitness) * (len(self.fitness) + 1) / 2 - 1)
+        for i in range(0, len(self.fitness)):
             sum += i + 1
             if value < sum:
                 return self.fitness[i][0]
         return None
     
     def computeFitness(self, state):
-        scoresMap = {}
-        for i in range(0, len(self.chromosomes)):
-            tempState = state
-            tempScore = -2147483648
-            for j in range(0,len(self.chromosomes[i])):
-                tempScore = scoreEvaluation(tempState)
-                if tempState.isWin() + tempState.isLose() == 0:
-                    tempState = tempState.generatePacmanSuccessor(self.chromosomes[i][j])
-                    if tempState is None:
-                        # generatePacmanSuccessor has been called maximum times
-                        return False
-                else:
-                    break
-            scoresMap.update({i: tempScore})
-        self.fitness = sorted(scoresMap.items(), key = lambda x: x[1])[:]
+        if self.workers > 1:
+            scores = self.parallelFitness()
+            if scores is None:
+                return False
+        else:
+            scores = []
+            for i in range(0, len(self.chromosomes)):
+                tempScore = chromosomeFitness(state, self.chromosomes[i], self.trie)
+                if tempScore is None:
+                    return False
+                scores.append(tempScore)
+        self.fitness = sorted(enumerate(scores), key = lambda x: x[1])[:]
         return True
+
+    # Sends the root state and a share of the budget to every worker, once
+    # per move.  Each worker is a pool of its own, so the root is known to
+    # be where its chromosomes are evaluated
+    def startWorkers(self, state):
+        if self.pools is None:
+            self.pools = [multiprocessing.Pool(1) for i in range(0, self.workers)]
+        for pool, share in zip(self.pools, util.splitBudget(Game.currentIterations, self.workers)):
+            pool.apply(setGeneticRoot, ((state, share, self.prefixCache and self.hitCost),))
+
+    # Splits the population between the workers.  Returns the scores, or
+    # None once a worker runs out of its share of the budget
+    def parallelFitness(self):
+        size = len(self.chromosomes)
+        results = []
+        for i in range(0, self.workers):
+            chromosomes = self.chromosomes[i * size / self.workers:(i + 1) * size / self.workers]
+            results.append(self.pools[i].apply_async(geneticFitness, (chromosomes,)))
+        scores = []
+        for result in results:
+            workerScores, used = result.get()
+            Game.currentIterations -= used
+            if workerScores is None:
+                scores = None
+            elif scores is not None:
+                scores += workerScores
+        return scores
     
     def generateChildren(self, indexA, indexB, nextGeneration):
         if random.randint(0, 9) < 7:
@@ -178,19 +372,23 @@ class GeneticAgent(Agent):
     def getAction(self, state):
         # Initialize population
         possible = state.getAllPossibleActions()
-        for i in range(0, 8):
+        for i in range(0, self.populationSize):
             tempChromosome = []
             for j in range(0, 5):
                 tempChromosome.append(possible[random.randint(0,len(possible)-1)])
             self.chromosomes[i] = tempChromosome[:]
         # Start evolution
+        if self.workers > 1:
+            self.startWorkers(state)
+        elif self.prefixCache:
+            self.trie = RolloutTrie(state, self.hitCost)
         nextGeneration = self.chromosomes[:]
         while self.computeFitness(state) is True:
             # Replace population
             self.chromosomes = nextGeneration[:]
             nextGeneration = []
             # Generate next generation
-            while len(nextGeneration) < len(self.chromosomes):
+            while len(nextGeneration) < self.populationSize:
                 # Select parents
                 parentAIndex = self.selectIndex()
                 parentBIndex = self.selectIndex()
@@ -198,6 +396,8 @@ class GeneticAgent(Agent):
                 #    parentBIndex = self.selectIndex()
                 # Generate children
                 self.generateChildren(parentAIndex, parentBIndex, nextGeneration)
+            # Children come in pairs, one too many for an odd population
+            del nextGeneration[self.populationSize:]
             # Mutate
             for i in range(0, len(nextGeneration)):
                 if random.randint(0, 9) < 1:
@@ -209,94 +409,630 @@ class GeneticAgent(Agent):
         #print survivor
         return self.chromosomes[survivor][0]
 
+    # Called when the game is over
+    def final(self, state):
+        if self.pools is not None:
+            util.closePools(*self.pools)
+            self.pools = None
+
+# The score of the state a chromosome leads to from state, or None once the
+# budget runs out.  With a trie (rooted at state), the chromosome is played
+# through it
+def chromosomeFitness(state, chromosome, trie=None):
+    tempState = state
+    tempScore = -2147483648
+    node = trie and trie.root
+    for j in range(0,len(chromosome)):
+        if node is None:
+            tempScore = scoreEvaluation(tempState)
+        else:
+            tempScore = node.getEvaluation()
+        if tempState.isWin() + tempState.isLose() == 0:
+            if trie is None:
+                tempState = tempState.generatePacmanSuccessor(chromosome[j])
+            else:
+                node = trie.getChild(node, chromosome[j])
+                tempState = node and node.state
+            if tempState is None:
+                # generatePacmanSuccessor has been called maximum times
+                return None
+        else:
+            break
+    return tempScore
+
+# The root state of a GeneticAgent worker process, for the current move,
+# and its RolloutTrie if the agent uses one
+geneticRoot = None
+geneticTrie = None
+
+def setGeneticRoot(job):
+    global geneticRoot, geneticTrie
+    geneticRoot, Game.currentIterations, hitCost = job
+    geneticTrie = None
+    if hitCost:
+        geneticTrie = RolloutTrie(geneticRoot, hitCost)
+
+# Runs in a worker process of GeneticAgent.parallelFitness.  Returns the
+# scores of chromosomes, or None once the worker's budget runs out, and the
+# number of iterations used
+def geneticFitness(chromosomes):
+    budget = Game.currentIterations
+    scores = []
+    for chromosome in chromosomes:
+        tempScore = chromosomeFitness(geneticRoot, chromosome, geneticTrie)
+        if tempScore is None:
+            scores = None
+            break
+        scores.append(tempScore)
+    return (scores, budget - Game.currentIterations)
+
+class GeneticPlannerAgent(Agent):
+    # A genetic algorithm over whole populations of action sequences at
+    # once (see geneticPlanner.py; needs NumPy).  Every generation is played
+    # out in a BatchSimulator and costs populationSize * length iterations
+    # of the budget, as many successors as evaluating it one state at a
+    # time would take.  Generations are played while the budget pays for
+    # them; if it can't pay for the first, the population shrinks to fit
+    def __init__(self, populationSize=20, length=5, elitism=2, crossoverRate=0.7, mutationRate=0.05):
+        self.populationSize = int(populationSize)
+        self.length = int(length)
+        self.elitism = int(elitism)
+        self.crossoverRate = float(crossoverRate)
+        self.mutationRate = float(mutationRate)
+
+    # GetAction Function: Called with every frame
+    def getAction(self, state):
+        populationSize = affordableGames(self.populationSize, self.length)
+        if populationSize < 2:
+            return random.choice(state.getLegalPacmanActions())
+        simulator = BatchSimulator(state, populationSize, random.randint(0, 2147483647))
+        planner = GeneticPlanner(populationSize, self.length, min(self.elitism, populationSize - 1),
+                                 self.crossoverRate, self.mutationRate, random.randint(0, 2147483647))
+        while True:
+            actions = planner.getActions()
+            fitness = simulator.rollout(actions)
+            Game.currentIterations -= populationSize * self.length
+            if affordableGames(populationSize, self.length) < populationSize:
+                break
+            planner.nextGeneration(fitness)
+        action = DIRECTIONS[actions[fitness.argmax()][0]]
+        # Illegal actions were played as Stop
+        if action not in state.getLegalPacmanActions():
+            action = Directions.STOP
+        return action
+
 class MCTSAgent(Agent):
-    # Monte Carlo Tree node
-    class Node(object):
-        def __init__(self):
-            self.parent = None
-            self.children = []
-            #self.terminal = False
-            #self.fullyExpanded = False
-            self.counter = 0
-            self.rewardSum = 0
-            self.action = None # parent =action=> this node
-            self.triedActions = set([])
+    # workers > 1 turns on root parallelization: each worker process grows
+    # its own tree from the root with its own share of the budget, and the
+    # statistics of the root children are merged before choosing.
+    # threads > 1 turns on tree parallelization instead: that many threads
+    # descend one shared tree, marking their paths with virtualLoss until
+    # their rollout, run in a pool of as many processes, comes back.  The
+    # two can't be combined.
+    # reuseTree keeps the subtree of the executed action between moves when
+    # the state the ghosts left us in was reached during the search.
+    # maxNodes caps the size of the tree (0 for no cap), and report prints
+    # the size of the tree after every move.  rave > 0 turns on RAVE, with
+    # rave as the number of visits at which a child's own mean reward and
+    # its all-moves-as-first mean weigh about the same.  A move there is an
+    # action taken from a given pacman position
+    def __init__(self, workers=1, reuseTree=True, threads=1, virtualLoss=1.0, maxNodes=0, report=False, rave=0):
+        self.workers = int(workers)
+        self.reuseTree = util.parseBool(reuseTree)
+        self.threads = int(threads)
+        self.virtualLoss = float(virtualLoss)
+        self.maxNodes = int(maxNodes)
+        self.report = util.parseBool(report)
+        self.rave = float(rave)
+        if self.workers > 1 and self.threads > 1:
+            raise Exception('MCTSAgent can\'t use both workers and threads')
+        self.pool = None
+        self.poolLayout = None
+        self.tree = None
+        self.lastAction = None
 
     # Initialization Function: Called one time when the game starts
     def registerInitialState(self, state):
-        return;
-    
+        self.tree = None
+
+    # A node v is (node number in self.tree, state)
+    # Leaves the pacman positions along the path, from the root down, in
+    # self.positions
     def treePolicy(self, v):
+        tree = self.tree
+        self.positions = [v[1].getPacmanPosition()]
         while v[1].isWin() + v[1].isLose() == 0:
-            if (set(v[1].getLegalPacmanActions()) - v[0].triedActions):
-                return self.expand(v)
+            if tree.getUntriedActions(v[0], v[1].getLegalPacmanActions()):
+                v = self.expand(v)
+                if v is not None:
+                    self.positions.append(v[1].getPacmanPosition())
+                return v
             else:
                 node = self.select(v)
-                v = (node, v[1].generatePacmanSuccessor(node.action))
+                if node == NONE:
+                    return None
+                v = (node, v[1].generatePacmanSuccessor(tree.getAction(node)))
                 if v[1] is None:
                     return None
+                tree.addOutcome(node, hash(v[1]))
+                self.positions.append(v[1].getPacmanPosition())
         return v
-    
+
     def expand(self, v):
         # Choose a untried action
-        legalActions = v[1].getLegalPacmanActions()
-        candidateActions = [x for x in (set(legalActions) - v[0].triedActions)]
-        if not candidateActions:
-            v[0].fullyExpanded = True
-            return v
-        else:
-            a = candidateActions[random.randint(0, len(candidateActions)-1)]
-            v[0].triedActions.add(a)
-            if len(v[0].triedActions) == len(legalActions):
-                v[0].fullyExpanded = True
-        # Add a new child
-        child = self.Node()
-        child.parent = v[0]
-        child.action = a
+        candidateActions = self.tree.getUntriedActions(v[0], v[1].getLegalPacmanActions())
+        a = candidateActions[random.randint(0, len(candidateActions)-1)]
         childState = v[1].generatePacmanSuccessor(a)
         if childState is None:
             #self.over = True
             return None
-        v[0].children.append(child)
+        self.tree.markTried(v[0], a)
+        # Add a new child
+        child = self.tree.addNode(v[0], a)
+        self.tree.addOutcome(child, hash(childState))
         return (child, childState)
-    
+
     def select(self, v):
         if v[1].isWin() + v[1].isLose() != 0:
-            print 1
             return v[0]
-        v[0].children.sort(key = lambda child: (child.rewardSum / child.counter + math.sqrt(2 * math.log(child.parent.counter) / child.counter)))
-        return v[0].children[-1]
-    
+        return self.tree.select(v[0], self.rave)
+
+    rolloutDepth = 5
+
+    # Leaves the moves it played in self.playedMoves, as a set of
+    # (position, action index)
     def defaultPolicy(self, state):
-        counter = 5
-        s = state
+        counter = self.rolloutDepth
+        s = SearchState(state)
+        self.playedMoves = set()
         while counter > 0 and (s.isWin() + s.isLose() == 0):
             legalActions = s.getLegalPacmanActions()
             a = legalActions[random.randint(0, len(legalActions)-1)]
-            s = s.generatePacmanSuccessor(a)
-            if s is None:
+            position = s.getPacmanPosition()
+            if not s.makeMove(a):
                 return None
+            self.playedMoves.add((position, ACTION_INDEX[a]))
             counter -= 1
         return normalizedScoreEvaluation(self.rootState, s)
-    
-    def backUp(self, node, reward):
-        while node is not None:
-            node.counter += 1
-            node.rewardSum += reward
-            node = node.parent
 
-    # GetAction Function: Called with every frame
-    def getAction(self, state):
+    def backUp(self, node, reward, positions=None, playedMoves=None):
+        self.tree.backUp(node, reward)
+        if self.rave > 0:
+            if positions is None:
+                positions, playedMoves = self.positions, self.playedMoves
+            self.tree.backUpAMAF(node, reward, positions, playedMoves)
+
+    # Grows self.tree from state until the budget runs out and returns it.
+    # The search continues in tree if one is given
+    def search(self, state, tree=None):
         #self.over = False
         self.rootState = state
         # Create root node
-        root = self.Node()
+        if tree is None:
+            tree = MCTSTree(self.maxNodes)
+        self.tree = tree
+        if self.threads > 1:
+            return self.sharedSearch(state)
         while True:
-            v1 = self.treePolicy((root, state))
+            v1 = self.treePolicy((tree.root, state))
             if v1 is not None:
                 reward = self.defaultPolicy(v1[1])
                 if reward is not None:
                     self.backUp(v1[0], reward)
                     continue
             break
-        return self.select((root, state)).action
+        return tree
+
+    # Starts the worker pool, sending it the layout of the game once; jobs
+    # then carry states without their layout (see stripLayout).  A pool
+    # left from a game on another layout is replaced
+    def startPool(self, processes, layout):
+        if self.pool is not None and self.poolLayout is not layout:
+            self.final(None)
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(processes, setWorkerLayout, (layout,))
+            self.poolLayout = layout
+
+    # Grows self.tree with several selection threads at once
+    def sharedSearch(self, state):
+        self.startPool(self.threads, state.data.layout)
+        self.lock = threading.Lock()
+        self.searching = True
+        threads = [threading.Thread(target=self.searchThread, args=(state,)) for i in range(0, self.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.tree
+
+    # One selection thread of sharedSearch.  The tree and the budget are only
+    # touched with the lock held; rollouts run in the pool without it.  Each
+    # rollout reserves its moves from the budget up front, so other threads
+    # can't spend them while it is in flight
+    def searchThread(self, state):
+        tree = self.tree
+        while True:
+            self.lock.acquire()
+            try:
+                if not self.searching:
+                    return
+                v1 = self.treePolicy((tree.root, state))
+                if v1 is None:
+                    self.searching = False
+                    return
+                positions = self.positions
+                tree.addVirtualLoss(v1[0], self.virtualLoss)
+                budget = Game.currentIterations
+                reserved = min(budget, self.rolloutDepth)
+                Game.currentIterations -= reserved
+                job = (stripLayout(v1[1]), budget, random.randint(0, 2147483647))
+            finally:
+                self.lock.release()
+            reward, used, playedMoves = self.pool.apply(rolloutWorker, (job,))
+            self.lock.acquire()
+            try:
+                Game.currentIterations += reserved - used
+                tree.removeVirtualLoss(v1[0], self.virtualLoss)
+                if reward is None:
+                    self.searching = False
+                    return
+                # The worker's reward is relative to the leaf
+                self.backUp(v1[0], reward + normalizedScoreEvaluation(self.rootState, v1[1]), positions, playedMoves)
+            finally:
+                self.lock.release()
+
+    # Runs one search per worker and merges the root children by action
+    def parallelSearch(self, state):
+        self.startPool(self.workers, state.data.layout)
+        jobs = []
+        stripped = stripLayout(state)
+        for share in util.splitBudget(Game.currentIterations, self.workers):
+            jobs.append((stripped, share, random.randint(0, 2147483647), self.maxNodes, self.rave))
+        tree = MCTSTree()
+        merged = {}
+        for children, used in self.pool.map(searchWorker, jobs):
+            Game.currentIterations -= used
+            for action, counter, rewardSum in children:
+                if counter == 0:
+                    continue
+                if action not in merged:
+                    merged[action] = tree.addNode(tree.root, action)
+                tree.counter[merged[action]] += counter
+                tree.rewardSum[merged[action]] += rewardSum
+                tree.counter[tree.root] += counter
+        self.tree = tree
+        return tree
+
+    # Finds the subtree reached by the action taken and the state the ghosts
+    # left us in, or None if that state wasn't sampled
+    def reRoot(self, state):
+        if self.tree is None or self.lastAction is None:
+            return None
+        child = self.tree.findChild(self.lastAction, hash(state))
+        if child == NONE:
+            return None
+        # Rewards were relative to the old root state
+        return self.tree.subtree(child, normalizedScoreEvaluation(self.rootState, state))
+
+    # GetAction Function: Called with every frame
+    def getAction(self, state):
+        if self.workers > 1:
+            tree = self.parallelSearch(state)
+        elif self.reuseTree:
+            tree = self.search(state, self.reRoot(state))
+        else:
+            tree = self.search(state)
+        # RAVE only guides the search: the move is chosen on the children's
+        # own statistics
+        child = tree.select(tree.root)
+        if child == NONE:
+            # The budget ran out before any rollout finished
+            legalActions = state.getLegalPacmanActions()
+            action = legalActions[random.randint(0, len(legalActions)-1)]
+        else:
+            action = tree.getAction(child)
+        self.tree, self.lastAction = tree, action
+        if self.report:
+            print 'MCTS tree: %d nodes, %d bytes' % (len(tree), tree.getByteSize())
+        return action
+
+    # Called when the game is over
+    def final(self, state):
+        self.tree = None
+        util.closePools(self.pool)
+        self.pool = None
+        self.poolLayout = None
+
+# The layout of the game the worker processes of MCTSAgent are searching,
+# sent once when the pool starts rather than with every job
+workerLayout = None
+
+def setWorkerLayout(layout):
+    global workerLayout
+    workerLayout = layout
+
+# A copy of state without its layout, which is most of a pickled state, to
+# send to a worker process.  The worker puts workerLayout back
+def stripLayout(state):
+    copy = GameState(state)
+    copy.data._win = state.data._win
+    copy.data._lose = state.data._lose
+    copy.data._hash = state.data._hash
+    copy.data.layout = None
+    return copy
+
+# Runs in a worker process of MCTSAgent.sharedSearch: one rollout from the
+# leaf with its own seed and budget.  Returns the reward, relative to the
+# leaf, the number of iterations used and the moves played
+def rolloutWorker(job):
+    state, budget, seed = job
+    state.data.layout = workerLayout
+    random.seed(seed)
+    Game.currentIterations = budget
+    agent = MCTSAgent()
+    agent.rootState = state
+    reward = agent.defaultPolicy(state)
+    return (reward, budget - Game.currentIterations, agent.playedMoves)
+
+# Runs in a worker process of MCTSAgent.parallelSearch: searches from the
+# root with its own seed and budget share, and returns the root children's
+# statistics and the number of iterations used
+def searchWorker(job):
+    state, budget, seed, maxNodes, rave = job
+    state.data.layout = workerLayout
+    random.seed(seed)
+    Game.currentIterations = budget
+    tree = MCTSAgent(maxNodes=maxNodes, rave=rave).search(state)
+    children = tree.getChildren(tree.root)
+    return ([(tree.getAction(c), tree.counter[c], tree.rewardSum[c]) for c in children], budget - Game.currentIterations)
+
+class TranspositionMCTSAgent(MCTSAgent):
+    # MCTS over a DAG of game states instead of a tree of action sequences:
+    # nodes are keyed by state hash in a table of at most tableSize entries
+    # (least recently used ones are evicted), so every path reaching a state
+    # shares its statistics, and so do later moves.  An entry is
+    # [visits, rewardSum] followed by the visits and reward sums of each
+    # action (indexed as in mctsTree.ACTIONS).  Rewards are absolute,
+    # scoreEvaluation / 1000, so they stay valid from one move to the next
+    def __init__(self, tableSize=100000):
+        MCTSAgent.__init__(self)
+        self.table = util.LRUCache(int(tableSize))
+
+    # Initialization Function: Called one time when the game starts
+    def registerInitialState(self, state):
+        self.table.clear()
+
+    def newEntry(self):
+        return [0, 0.0] + [0] * len(ACTIONS) + [0.0] * len(ACTIONS)
+
+    # The action of entry with the highest UCB value, trying every legal
+    # action once first
+    def selectAction(self, entry, legalActions):
+        numActions = len(ACTIONS)
+        untried = [a for a in legalActions if entry[2 + ACTION_INDEX[a]] == 0]
+        if untried:
+            return untried[random.randint(0, len(untried)-1)]
+        logTotal = 2 * math.log(entry[0])
+        best, bestValue = None, None
+        for a in legalActions:
+            i = ACTION_INDEX[a]
+            n = entry[2 + i]
+            value = entry[2 + numActions + i] / n + math.sqrt(logTotal / n)
+            if best is None or value > bestValue:
+                best, bestValue = a, value
+        return best
+
+    # One iteration: descends through known states, adds the first unknown
+    # one to the table and rolls out from it.  Returns False once the budget
+    # runs out
+    def simulate(self, state):
+        path = []
+        while state.isWin() + state.isLose() == 0:
+            stateHash = hash(state)
+            entry = self.table.get(stateHash)
+            if entry is None:
+                entry = self.newEntry()
+                self.table[stateHash] = entry
+                if path:
+                    reward = self.defaultPolicy(state)
+                    if reward is None:
+                        return False
+                    break
+            a = self.selectAction(entry, state.getLegalPacmanActions())
+            state = state.generatePacmanSuccessor(a)
+            if state is None:
+                return False
+            path.append((entry, ACTION_INDEX[a]))
+        else:
+            entry = None
+            reward = normalizedScoreEvaluation(self.rootState, state)
+        reward += self.rootValue
+        if entry is not None:
+            entry[0] += 1
+            entry[1] += reward
+        numActions = len(ACTIONS)
+        for entry, i in path:
+            entry[0] += 1
+            entry[1] += reward
+            entry[2 + i] += 1
+            entry[2 + numActions + i] += reward
+        return True
+
+    # GetAction Function: Called with every frame
+    def getAction(self, state):
+        self.rootState = state
+        self.rootValue = scoreEvaluation(state) / 1000.0
+        while self.simulate(state):
+            pass
+        entry = self.table.get(hash(state))
+        legalActions = state.getLegalPacmanActions()
+        if entry is None or entry[0] == 0:
+            return legalActions[random.randint(0, len(legalActions)-1)]
+        # Only compare the actions that were tried
+        return self.selectAction(entry, [a for a in legalActions if entry[2 + ACTION_INDEX[a]] > 0])
+
+    # Called when the game is over
+    def final(self, state):
+        self.table.clear()
+
+# Tells states apart for AStarAgent's closed set: the Zobrist hash of the
+# state without its score (which depends on the path taken) or pacman's
+# direction, paired with pacman's position
+def searchKey(state):
+    pacmanState = state.data.agentStates[0]
+    h = hash(state) ^ ZobristKeys.score(state.data.score) ^ ZobristKeys.agent(0, pacmanState.configuration, pacmanState.scaredTimer)
+    return (h, pacmanState.getPosition())
+
+class AStarAgent(Agent):
+    # A* from the current state to a win, with the number of moves as the
+    # cost and, by the heuristic agent argument, foodDistanceHeuristic
+    # ('foodDistance') or pelletsHeuristic ('pellets') as the heuristic.
+    # The frontier is a heap of (f, -g, insertion order, ...), so ties on f
+    # go to the deeper node, and the closed set holds searchKeys.  Stop is
+    # never expanded.  The agent follows the path to a win, or when the
+    # budget runs out to the node with the lowest heuristic (then the most
+    # moves away), for as long as the game goes as predicted, and searches
+    # again when it doesn't.  report prints the search counters after every
+    # search
+    heuristics = {'foodDistance': foodDistanceHeuristic, 'pellets': pelletsHeuristic}
+
+    def __init__(self, heuristic='foodDistance', report=False):
+        self.heuristic = self.heuristics[heuristic]
+        self.report = util.parseBool(report)
+        self.plan = []
+        self.expectedKey = None
+
+    # Initialization Function: Called one time when the game starts
+    def registerInitialState(self, state):
+        self.plan = []
+
+    # GetAction Function: Called with every frame
+    def getAction(self, state):
+        if self.plan and searchKey(state) == self.expectedKey:
+            action, self.expectedKey = self.plan.pop(0)
+            return action
+        self.expanded = self.maxFrontier = 0
+        start = time.time()
+        path, won = self.search(state)
+        if self.report:
+            self.printCounters(time.time() - start)
+        if not path:
+            legal = [a for a in state.getLegalPacmanActions() if a != Directions.STOP] or [Directions.STOP]
+            return random.choice(legal)
+        self.plan = path[1:]
+        action, self.expectedKey = path[0]
+        return action
+
+    def printCounters(self, elapsed):
+        print 'A*: %d nodes expanded (%.0f/s), frontier up to %d' % (self.expanded, self.expanded / max(elapsed, 1e-6), self.maxFrontier)
+
+    # Returns the path, as (action, searchKey of the state it leads to)
+    # pairs, to a win or to the best node reached, and whether it wins
+    def search(self, root):
+        frontier = [(self.heuristic(root), 0, 0, root, None)]
+        closed = set()
+        best = None
+        won = False
+        order = 0
+        while frontier:
+            f, negativeG, tie, state, node = heapq.heappop(frontier)
+            key = searchKey(state)
+            if key in closed:
+                continue
+            closed.add(key)
+            h = f + negativeG
+            if best is None or (h, negativeG) < best[:2]:
+                best = (h, negativeG, node)
+            if state.isWin():
+                best = (h, negativeG, node)
+                won = True
+                break
+            if state.isLose():
+                continue
+            self.expanded += 1
+            g = 1 - negativeG
+            for action in state.getLegalPacmanActions():
+                if action == Directions.STOP:
+                    continue
+                child = state.generatePacmanSuccessor(action)
+                if child is None:
+                    # generatePacmanSuccessor has been called maximum times
+                    frontier = []
+                    break
+                childKey = searchKey(child)
+                if childKey in closed:
+                    continue
+                order += 1
+                heapq.heappush(frontier, (g + self.heuristic(child), -g, order, child, (action, childKey, node)))
+            self.maxFrontier = max(self.maxFrontier, len(frontier))
+        path = []
+        node = best[2]
+        while node is not None:
+            path.append(node[:2])
+            node = node[2]
+        path.reverse()
+        return path, won
+
+class IDAStarAgent(AStarAgent):
+    # Iterative deepening A*: depth-first searches bounded by f, the bound
+    # rising to the smallest f that went over it, with one SearchState made
+    # and unmade in place.  Memory only grows with the depth of the path;
+    # cycles are only checked against the current path
+    def printCounters(self, elapsed):
+        print 'IDA*: %d nodes expanded (%.0f/s), %d iterations, depth up to %d' % (self.expanded, self.expanded / max(elapsed, 1e-6), self.iterations, self.maxFrontier)
+
+    def search(self, root):
+        self.iterations = 0
+        self.outOfBudget = False
+        self.best = (self.heuristic(root), 0, [])  # (h, -g, path)
+        s = SearchState(root)
+        bound = self.best[0]
+        while not self.outOfBudget and bound is not None:
+            self.iterations += 1
+            path = []
+            bound = self.boundedSearch(s, 0, bound, path, set([searchKey(s)]))
+            if bound == 0:
+                return path, True
+        return self.best[2], False
+
+    # Searches below s, at depth g on path, for a win within bound.  Returns
+    # 0 if one was found (and leaves it in path), otherwise the smallest f
+    # over the bound, or None if there was none
+    def boundedSearch(self, s, g, bound, path, onPath):
+        self.expanded += 1
+        self.maxFrontier = max(self.maxFrontier, g)
+        nextBound = None
+        for action in s.getLegalPacmanActions():
+            if action == Directions.STOP:
+                continue
+            if not s.makeMove(action):
+                # generatePacmanSuccessor has been called maximum times
+                self.outOfBudget = True
+                return None
+            key = searchKey(s)
+            h = self.heuristic(s)
+            f = g + 1 + h
+            if key not in onPath and not s.isLose():
+                path.append((action, key))
+                if (h, -g - 1) < self.best[:2]:
+                    self.best = (h, -g - 1, path[:])
+                if s.isWin():
+                    s.unmakeMove()
+                    return 0
+                if f > bound:
+                    if nextBound is None or f < nextBound:
+                        nextBound = f
+                else:
+                    onPath.add(key)
+                    result = self.boundedSearch(s, g + 1, bound, path, onPath)
+                    onPath.discard(key)
+                    if result == 0:
+                        s.unmakeMove()
+                        return 0
+                    if result is not None and (nextBound is None or result < nextBound):
+                        nextBound = result
+                path.pop()
+            s.unmakeMove()
+            if self.outOfBudget:
+                return None
+        return nextBound
@@ -29,6 +29,7 @@
 import sys
 import inspect
 import heapq, random
+import collections
 import cStringIO
 
 
@@ -350,6 +351,51 @@ class Counter(dict):
             addend[key] = -1 * y[key]
         return addend
 
+class LRUCache:
+    """
+    A mapping that holds at most maxSize items.  Adding an item to a full
+    cache evicts the least recently used one.
+
+    >>> c = LRUCache(2)
+    >>> c['a'] = 1
+    >>> c['b'] = 2
+    >>> c.get('a')
+    1
+    >>> c['c'] = 3
+    >>> print c.get('b')
+    None
+    """
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.items = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        """
+        Returns the value for key, marking it as the most recently used.
+        """
+        try:
+            value = self.items.pop(key)
+        except KeyError:
+            return default
+        self.items[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self.items:
+            del self.items[key]
+        elif len(self.items) >= self.maxSize:
+            self.items.popitem(last=False)
+        self.items[key] = value
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def clear(self):
+        self.items.clear()
+
 def raiseNotDefined():
     fileName = inspect.stack()[1][1]
     line = inspect.stack()[1][2]
@@ -426,6 +472,30 @@ def flipCoin( p ):
     r = random.random()
     return r < p
 
+def parseBool( value ):
+    """
+    Reads a flag given with --agentArgs, where values arrive as strings:
+    anything but 0, false or no (in any case) is True.
+    """
+    return str(value).lower() not in ('0', 'false', 'no')
+
+def splitBudget( budget, n ):
+    """
+    Splits budget into n whole shares as evenly as possible, the first
+    budget % n shares getting one more.
+    """
+    return [budget / n + (1 if i < budget % n else 0) for i in range(n)]
+
+def closePools( *pools ):
+    """
+    Closes the multiprocessing pools given, skipping Nones, and waits for
+    their workers to exit.
+    """
+    for pool in pools:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
 def chooseFromDistribution( distribution ):
     "Takes either a counter or a list of (prob, key) pairs and samples"
     if type(distribution) == dict or type(distribution) == Counter: